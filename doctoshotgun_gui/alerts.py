@@ -0,0 +1,153 @@
+"""
+Alerts of slots found.
+
+A slot only stays available for a few minutes, so the user is told as
+soon as the search engine finds one, even when the app isn't in the
+foreground: by a desktop notification, and optionally by a local webhook
+or a command. Each channel is run from its own thread, so a slow one
+doesn't hold the search or the others, and the delay between the probe
+returning the slot and the alert is measured for each channel.
+
+Channels are set by these keys of the headless config, or of alerts.json
+in the GUI's data directory::
+
+    {"alert_desktop": true,
+     "alert_webhook": "http://127.0.0.1:8080/doctoshotgun",
+     "alert_command": "paplay /usr/share/sounds/freedesktop/stereo/complete.oga"}
+
+The webhook receives the alert as JSON, and the command in the
+DOCTOSHOTGUN_ALERT environment variable.
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from doctoshotgun_gui.files import read_json
+from doctoshotgun_gui.metrics import METRICS
+
+
+def describe(kind, appointment, center=None, patient=None):
+    """
+    :param kind: 'found', or 'booked' when booked automatically
+    :returns: the alert, as sent to webhooks
+    """
+    return {'kind': kind,
+            'center': appointment.name,
+            'address': appointment.address,
+            'zipcode': appointment.zipcode,
+            'city': appointment.city,
+            'vaccine': appointment.vaccine,
+            'slots': [slot.isoformat() for slot in appointment.slots],
+            'patient': '%(first_name)s %(last_name)s' % patient if patient else None,
+            'url': center['url'] if center else None,
+           }
+
+
+def summary(alert):
+    title = 'Slot booked!' if alert['kind'] == 'booked' else 'Slot found!'
+    return title, '%s, %s: %s' % (alert['center'], alert['city'], alert['slots'][0])
+
+
+class Webhook:
+    TIMEOUT = 5
+
+    def __init__(self, url):
+        self.url = url
+
+    def __call__(self, alert):
+        request = urllib.request.Request(self.url, data=json.dumps(alert).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.TIMEOUT):
+            pass
+
+
+class Command:
+    TIMEOUT = 30
+
+    def __init__(self, command):
+        self.command = command
+
+    def __call__(self, alert):
+        env = dict(os.environ, DOCTOSHOTGUN_ALERT=json.dumps(alert))
+        subprocess.run(self.command, shell=isinstance(self.command, str), env=env,
+                       timeout=self.TIMEOUT, check=True)
+
+
+def desktop_notification():
+    """
+    :returns: the channel showing alerts as notifications of the desktop,
+              or None if there is no way to show them
+    """
+    if sys.platform == 'darwin':
+        def notify(alert):
+            title, text = summary(alert)
+            subprocess.run(['osascript', '-e', 'display notification %s with title %s sound name "Glass"'
+                            % (json.dumps(text), json.dumps(title))], timeout=Command.TIMEOUT, check=True)
+        return notify
+
+    if shutil.which('notify-send'):
+        def notify(alert):
+            subprocess.run(['notify-send', '--urgency=critical', '--app-name=Doctoshotgun'] + list(summary(alert)),
+                           timeout=Command.TIMEOUT, check=True)
+        return notify
+    return None
+
+
+class Alerts:
+    def __init__(self, metrics=None):
+        self.metrics = metrics or METRICS
+        # (name, callable taking the alert)
+        self.channels = []
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='doctoshotgun-alert')
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        alerts = cls(metrics)
+        if config.get('alert_desktop', True):
+            notify = desktop_notification()
+            if notify is not None:
+                alerts.add('desktop', notify)
+        if config.get('alert_webhook'):
+            alerts.add('webhook', Webhook(config['alert_webhook']))
+        if config.get('alert_command'):
+            alerts.add('command', Command(config['alert_command']))
+        return alerts
+
+    @classmethod
+    def load(cls, path, metrics=None):
+        """
+        Channels set in a JSON file, if it exists.
+        """
+        return cls.from_config(read_json(path), metrics)
+
+    def add(self, name, channel):
+        self.channels.append((name, channel))
+
+    def alert(self, kind, appointment, center, patient, seen):
+        """
+        Send an alert on every channel, without waiting for them.
+
+        :param seen: time.monotonic() when the probe returned the slot
+        """
+        alert = describe(kind, appointment, center, patient)
+        for name, channel in self.channels:
+            self.executor.submit(self.send, name, channel, alert, seen)
+
+    def send(self, name, channel, alert, seen):
+        try:
+            channel(alert)
+        except Exception as exc:
+            self.metrics.inc('alert_errors_total', channel=name)
+            logging.getLogger(__name__).warning('Unable to send the alert by %s: %s', name, exc)
+            return
+
+        self.metrics.observe('found_to_alerted_seconds', time.monotonic() - seen, channel=name, kind=alert['kind'])
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,40 @@
+"""
+Answers of each patient to the custom fields of booking forms.
+
+They are saved when the user books a slot, so the next booking for the
+same patient, possibly automatic, doesn't need to ask them again.
+"""
+import json
+import threading
+
+from doctoshotgun_gui.files import read_json, write_atomic
+
+
+class AnswerStore:
+    FILENAME = 'answers.json'
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.answers = self.load()
+
+    def load(self):
+        return read_json(self.path)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            data = json.dumps(self.answers)
+
+        write_atomic(self.path, data)
+
+    def get(self, patient):
+        with self.lock:
+            return dict(self.answers.get(str(patient['id']), {}))
+
+    def update(self, patient, answers):
+        with self.lock:
+            self.answers.setdefault(str(patient['id']), {}).update(answers)
+        self.save()
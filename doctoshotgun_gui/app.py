@@ -2,19 +2,23 @@
 Book vaccine slots on Doctolib
 """
 import asyncio
-import concurrent.futures
-import os
-import json
+import collections
+import time
 import webbrowser
-from datetime import datetime, date
-from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 
 import toga
 from toga.style import Pack
 from toga.style.pack import COLUMN, ROW
 
-from woob.exceptions import ScrapingBlocked, BrowserInteraction
-from doctoshotgun.doctolib import DoctolibFR, DoctolibDE, Appointment
+from doctoshotgun_gui import geo
+
+# The scraping stack (woob, doctoshotgun, requests…) is slow to import,
+# especially on phones. It is imported by load_engine(), from a thread,
+# while the first screen is shown. Check with
+# "python -m doctoshotgun_gui.importtime" that this module doesn't
+# import it again.
 
 def disable_button(button):
     button.enabled = False
@@ -25,38 +29,176 @@ def enable_button(button):
     button.style.background_color = '#383D76'
 
 
+class ProgressLog:
+    """
+    Last lines of progress of the search, shown in labels.
+
+    Lines are kept in a ring buffer, and labels are updated at most
+    :attr:`REFRESH_RATE` times per second, however fast events come.
+    """
+
+    REFRESH_RATE = 10
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.lines = collections.deque(maxlen=len(labels))
+        self.handle = None
+
+    def clear(self):
+        self.lines.clear()
+        self.render()
+
+    def add(self, text):
+        self.lines.append(text)
+        self.changed()
+
+    def append(self, text):
+        if not self.lines:
+            return self.add(text)
+        self.lines[-1] += text
+        self.changed()
+
+    def changed(self):
+        if self.handle is None:
+            self.handle = asyncio.get_event_loop().call_later(1 / self.REFRESH_RATE, self.render)
+
+    def render(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        # Lines fill the labels from the bottom.
+        lines = [''] * (len(self.labels) - len(self.lines)) + list(self.lines)
+        for label, text in zip(self.labels, lines):
+            if label.text != text:
+                label.text = text
+
+
 class Doctoshotgun(toga.App):
-    countries = {'France': DoctolibFR,
-                 'Germany': DoctolibDE,
+    # Browser classes in doctoshotgun.doctolib.
+    countries = {'France': 'DoctolibFR',
+                 'Germany': 'DoctolibDE',
                 }
-
+    country_codes = {'France': 'FR',
+                     'Germany': 'DE',
+                    }
+    # Motive keys of the browser classes, the ones switched on by default.
+    motives = {'Pfizer, first dose': ('KEY_PFIZER', False),
+               'Pfizer, second dose': ('KEY_PFIZER_SECOND', False),
+               'Pfizer, booster': ('KEY_PFIZER_THIRD', True),
+               'Moderna, first dose': ('KEY_MODERNA', False),
+               'Moderna, second dose': ('KEY_MODERNA_SECOND', False),
+               'Moderna, booster': ('KEY_MODERNA_THIRD', True),
+               'Janssen': ('KEY_JANSSEN', False),
+              }
+
+    RADIUS = 10
+    MAX_CITIES = 20
+    # Searched for a ZIP code of a country without a postal code index.
+    DEFAULT_CITIES = {'FR': ['paris'],
+                      'DE': ['berlin'],
+                     }
+    PROGRESS_LINES = 4
+
+    # Single session file of previous versions.
     STATE_FILENAME = 'state.json'
+    # Alert channels, see alerts.py.
+    ALERTS_FILENAME = 'alerts.json'
 
     docto = None
-    patient_input = None
+    # Patients to find a slot for, and without one yet.
+    selected = ()
     custom_fields = None
+    found_at = None
+    appointment = None
+    map_view = None
 
-    def load_state(self):
-        print('===== LOAD FROM', self.paths.data)
-        try:
-            with open(self.paths.data / self.STATE_FILENAME, 'r') as fp:
-                state = json.load(fp)
-                print(state)
-        except IOError:
-            return {}
-        else:
-            return state
-
-    def save_state(self, state):
-        print('==== DUMP TO', self.paths.data / self.STATE_FILENAME)
-        if not os.path.exists(self.paths.data):
-            os.makedirs(self.paths.data)
-        with open(self.paths.data / self.STATE_FILENAME, 'w') as fp:
-            json.dump(state, fp)
+    async def get_engine(self):
+        return await asyncio.wrap_future(self.engine_future)
+
+    async def run(self, func, *args):
+        """
+        Run a blocking call in the engine's worker thread and wait for it
+        without blocking the main loop.
+        """
+        engine = await self.get_engine()
+        return await asyncio.wrap_future(engine.submit(func, *args))
+
+    def load_engine(self, country):
+        """
+        Import the scraping stack and create the search engine, then
+        prepare a browser for the selected country.
+        """
+        from doctoshotgun_gui.alerts import Alerts
+        from doctoshotgun_gui.answers import AnswerStore
+        from doctoshotgun_gui.cache import CenterCache
+        from doctoshotgun_gui.engine import SearchEngine
+        from doctoshotgun_gui.journal import Journal
+        from doctoshotgun_gui.maps import MapCache
+        from doctoshotgun_gui.sessions import SessionStore
+        from doctoshotgun_gui.slots import SlotIndex
+        from doctoshotgun_gui.stats import CenterStats
+
+        self.sessions = SessionStore(self.paths.data / SessionStore.FILENAME,
+                                     legacy_path=self.paths.data / self.STATE_FILENAME)
+        self.answers = AnswerStore(self.paths.data / AnswerStore.FILENAME)
+        self.maps = MapCache(self.paths.cache / MapCache.DIRNAME)
+        alerts = Alerts.load(self.paths.data / self.ALERTS_FILENAME)
+        alerts.add('window', self.show_alert)
+        self.engine = SearchEngine(cache=CenterCache(self.paths.data / CenterCache.FILENAME),
+                                   sessions=self.sessions,
+                                   slots=SlotIndex(self.paths.data / SlotIndex.FILENAME),
+                                   journal=Journal(self.paths.data / Journal.FILENAME),
+                                   stats=CenterStats(self.paths.data / CenterStats.FILENAME),
+                                   alerts=alerts, long_run=True)
+        self.engine.submit(self.prepare_browser, country)
+        return self.engine
+
+    def browser_class(self, country):
+        from doctoshotgun import doctolib
+        return getattr(doctolib, self.countries[country])
+
+    def prepare_browser(self, country):
+        self.engine.prepare_browser(self.browser_class(country))
+
+    def new_browser(self, country, username, password):
+        return self.engine.new_browser(self.browser_class(country), username, password)
+
+    async def country_selected(self, widget):
+        if widget.value:
+            await self.run(self.prepare_browser, widget.value)
+
+    def show_alert(self, alert):
+        """
+        Bring the window to the front, from the thread of the alert, as soon
+        as the search engine finds a slot. It beeps too with versions of
+        toga having App.beep().
+        """
+        async def show():
+            self.main_window.show()
+            if hasattr(self, 'beep'):
+                self.beep()
+
+        asyncio.run_coroutine_threadsafe(show(), self.loop).result(5)
+
+    def show_screen(self, name, build):
+        """
+        Show a screen, built by `build` the first time only. Callers update
+        its widgets in place.
+        """
+        if name not in self.screens:
+            self.screens[name] = build()
+        self.main_window.content = self.screens[name]
+        self.main_window.show()
 
     def exit_handler(self, app):
+        if not self.engine_future.done() or self.engine_future.exception():
+            return True
+
+        self.engine.shutdown()
         if self.docto:
-            self.save_state(self.docto.dump_state())
+            self.sessions.save(self.docto)
+        self.sessions.close()
         return True
 
     def startup(self):
@@ -69,6 +211,14 @@ class Doctoshotgun(toga.App):
         """
 
         self.on_exit = self.exit_handler
+        self.screens = {}
+        self.loop = asyncio.get_event_loop()
+
+        # Load the scraping stack while the first screen is shown, and
+        # prepare a browser for the country selected by default.
+        loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='doctoshotgun-load')
+        self.engine_future = loader.submit(self.load_engine, list(self.countries)[0])
+        loader.shutdown(wait=False)
 
         intro1 = toga.Label('When and where', style=Pack(font_weight='bold', font_size=16, color='#383D76'))
         intro2 = toga.Label('would you like to book a vaccine slot?', style=Pack(font_size=14, color='#383D76'))
@@ -77,15 +227,26 @@ class Doctoshotgun(toga.App):
 
         self.country_label = toga.Label('Country', style=Pack(color='#383D76'))
         self.country_input = toga.Selection(items=list(self.countries.keys()),
-                                            style=Pack(padding_top=10, color='#383D76'))
+                                            style=Pack(padding_top=10, color='#383D76'),
+                                            on_select=self.country_selected)
         country_box = toga.Box(style=Pack(direction=COLUMN, padding=20, color='#383D76'),
                                children=[self.country_label, self.country_input])
 
-        self.zip_label = toga.Label('ZIP code', style=Pack(color='#383D76'))
-        self.zip_input = toga.TextInput(style=Pack(color='#383D76'))
-        zip_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
+        self.zip_label = toga.Label('ZIP code or cities', style=Pack(color='#383D76'))
+        self.zip_input = toga.TextInput(style=Pack(flex=1, color='#383D76'))
+        zip_code_box = toga.Box(style=Pack(direction=COLUMN, padding_right=10, flex=1),
                              children=[self.zip_label, self.zip_input])
 
+        self.radius_label = toga.Label('Radius (km)', style=Pack(color='#383D76'))
+        self.radius_input = toga.TextInput(style=Pack(flex=1, color='#383D76'),
+                                           initial=str(self.RADIUS))
+        radius_box = toga.Box(style=Pack(direction=COLUMN, padding_left=10, flex=1),
+                             children=[self.radius_label, self.radius_input])
+
+        zip_box = toga.Box(style=Pack(direction=ROW, padding=20),
+                           children=[zip_code_box,
+                                     radius_box])
+
         self.start_date_label = toga.Label('From', style=Pack(color='#383D76'))
         self.start_date_input = toga.TextInput(style=Pack(flex=1, color='#383D76'),
                                                initial=date.today().strftime('%d/%m/%Y'))
@@ -94,7 +255,7 @@ class Doctoshotgun(toga.App):
 
         self.end_date_label = toga.Label('To', style=Pack(color='#383D76'))
         self.end_date_input = toga.TextInput(style=Pack(flex=1, color='#383D76'),
-                                             initial=(date.today() + relativedelta(days=30)).strftime('%d/%m/%Y'))
+                                             initial=(date.today() + timedelta(days=30)).strftime('%d/%m/%Y'))
         end_date_box = toga.Box(style=Pack(direction=COLUMN, padding_left=10, flex=1),
                              children=[self.end_date_label, self.end_date_input])
 
@@ -121,12 +282,40 @@ class Doctoshotgun(toga.App):
         #a.slots = [datetime.now()]
         #self.confirm_center(a)
 
+    def find_cities(self, country, value, radius):
+        """
+        Cities within `radius` km of a ZIP code, or the cities typed instead,
+        separated by commas.
+
+        :returns: the position of the ZIP code if known, and the cities
+        """
+        if not value.strip().isdigit():
+            return None, [name for name in map(geo.slugify, value.split(',')) if name]
+
+        origin, cities = geo.find_cities(country, value, radius, self.MAX_CITIES)
+        if cities is None:
+            # No postal code index is bundled for this country.
+            return None, self.DEFAULT_CITIES[country]
+        return origin, cities
+
     async def go_to_login(self, widget):
         self.country = self.country_input.value
         self.start_date = datetime.strptime(self.start_date_input.value, '%d/%m/%Y').date()
         self.end_date = datetime.strptime(self.end_date_input.value, '%d/%m/%Y').date()
         self.zip = self.zip_input.value
+        self.radius = float(self.radius_input.value or self.RADIUS)
+
+        self.origin, self.cities = await self.run(self.find_cities, self.country_codes[self.country],
+                                                  self.zip, self.radius)
+        if not self.cities:
+            self.zip_label.style.color = '#ff0000'
+            self.zip_input.style.color = '#ff0000'
+            return
 
+        self.show_screen('login', self.build_login_screen)
+        self.login_input.focus()
+
+    def build_login_screen(self):
         validate_button = toga.Button('Continue',
                                       style=Pack(padding=20, background_color='#383D76', color='#ffffff'),
                                       on_press=self.login)
@@ -155,25 +344,22 @@ class Doctoshotgun(toga.App):
         password_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
                                            children=[self.password_label, self.password_input])
 
-        main_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
-                            children=[intro_box,
-                                      login_box,
-                                      password_box,
-                                      validate_button])
-
-        self.main_window.content = main_box
-        self.main_window.show()
+        return toga.Box(style=Pack(direction=COLUMN, padding=20),
+                        children=[intro_box,
+                                  login_box,
+                                  password_box,
+                                  validate_button])
 
-        self.login_input.focus()
+    async def login(self, widget):
+        from woob.exceptions import ScrapingBlocked, BrowserInteraction
 
-    def login(self, widget):
         disable_button(widget)
 
-        klass = self.countries[self.country]
-        self.docto = klass(self.login_input.value, self.password_input.value)
-        self.docto.load_state(self.load_state())
+        self.docto = self.engine.docto = await self.run(self.new_browser, self.country,
+                                                        self.login_input.value, self.password_input.value)
+        await self.run(self.sessions.restore, self.docto)
         try:
-            if not self.docto.do_login():
+            if not await self.run(self.docto.do_login):
                 enable_button(widget)
                 self.login_label.style.color = '#ff0000'
                 self.login_input.style.color = '#ff0000'
@@ -187,9 +373,15 @@ class Doctoshotgun(toga.App):
         except BrowserInteraction as e:
             return self.go_to_otp()
 
-        self.go_to_vaccine()
+        await self.go_to_vaccine()
 
     def go_to_otp(self):
+        self.show_screen('otp', self.build_otp_screen)
+        for x in range(6):
+            getattr(self, 'code%s_input' % (x+1)).value = ''
+        self.code1_input.focus()
+
+    def build_otp_screen(self):
         intro1 = toga.Label('Enter the code received', style=Pack(font_weight='bold', font_size=16, color='#383D76'))
         intro2 = toga.Label('at your email address from Doctolib', style=Pack(font_size=14, color='#383D76'))
         intro_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_bottom=50),
@@ -232,62 +424,125 @@ class Doctoshotgun(toga.App):
         code_box = toga.Box(style=Pack(direction=COLUMN, padding=30),
                             children=[self.code_label, code_input_box])
 
-        main_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
-                            children=[intro_box,
-                                      code_box,
-                                      validate_button])
+        return toga.Box(style=Pack(direction=COLUMN, padding=20),
+                        children=[intro_box,
+                                  code_box,
+                                  validate_button])
 
-        self.main_window.content = main_box
-        self.main_window.show()
-
-        self.code1_input.focus()
-
-    def send_otp(self, widget):
+    async def send_otp(self, widget):
         disable_button(widget)
 
         code = ''
         for x in range(6):
             code += getattr(self, 'code%s_input' % (x+1)).value
 
-        if not self.docto.do_otp(code):
+        if not await self.run(self.docto.do_otp, code):
             self.main_window.info_dialog('Oops', 'Invalid auth code')
             enable_button(widget)
             return
 
         # Save storage to prevent doing OTP next time.
-        self.save_state(self.docto.dump_state())
-
-        self.go_to_vaccine()
-
-    def go_to_vaccine(self):
-        self.patients = {'%(first_name)s %(last_name)s' % patient: patient for patient in self.docto.get_patients()}
-        if len(self.patients) > 0:
-            self.patient_label = toga.Label('Patient', style=Pack(color='#383D76'))
-            self.patient_input = toga.Selection(items=list(self.patients.keys()),
-                                                style=Pack(padding_top=10, color='#383D76'))
-            patient_box = toga.Box(style=Pack(direction=COLUMN, padding=20, color='#383D76'),
-                                   children=[self.patient_label, self.patient_input])
-        else:
-            self.patient_input = None
-            patient_box = None
-            self.docto.patient = list(self.patients.values())[0]
+        self.sessions.save(self.docto)
+
+        await self.go_to_vaccine()
+
+    async def go_to_vaccine(self):
+        patients = await self.run(self.docto.get_patients)
+        self.patients = {'%(first_name)s %(last_name)s' % patient: patient for patient in patients}
+
+        self.show_screen('vaccine', self.build_vaccine_screen)
+        for switch in self.patient_inputs.values():
+            self.patient_box.remove(switch)
+        self.patient_inputs = {}
+        for name in self.patients:
+            # The account's owner comes first.
+            self.patient_inputs[name] = toga.Switch(name, is_on=not self.patient_inputs,
+                                                    style=Pack(padding_top=10, color='#383D76'))
+            self.patient_box.add(self.patient_inputs[name])
+
+    def build_vaccine_screen(self):
+        self.patient_label = toga.Label('Patients', style=Pack(color='#383D76'))
+        self.patient_inputs = {}
+        self.patient_box = toga.Box(style=Pack(direction=COLUMN, padding=20, color='#383D76'),
+                                    children=[self.patient_label])
+
+        self.motive_label = toga.Label('Vaccines', style=Pack(color='#383D76'))
+        self.motive_inputs = {name: toga.Switch(name, is_on=default, style=Pack(padding_top=10, color='#383D76'))
+                              for name, (key, default) in self.motives.items()}
+        motive_box = toga.Box(style=Pack(direction=COLUMN, padding=20, color='#383D76'),
+                              children=[self.motive_label] + list(self.motive_inputs.values()))
+
+        self.auto_book_input = toga.Switch('Book the first slot found automatically',
+                                           style=Pack(padding=20, color='#383D76'))
 
         validate_button = toga.Button('Continue',
                                       style=Pack(padding=20, background_color='#383D76', color='#ffffff'),
-                                      on_press=self.find_centers)
+                                      on_press=self.start_search)
+
+        return toga.Box(style=Pack(direction=COLUMN, padding=20),
+                        children=[self.patient_box,
+                                  motive_box,
+                                  self.auto_book_input,
+                                  validate_button])
+
+    async def start_search(self, widget):
+        self.selected = [self.patients[name] for name, switch in self.patient_inputs.items() if switch.is_on]
+        self.selected_motives = [getattr(self.docto, self.motives[name][0])
+                                 for name, switch in self.motive_inputs.items() if switch.is_on]
+        self.patient_label.style.color = '#383D76' if self.selected else '#ff0000'
+        self.motive_label.style.color = '#383D76' if self.selected_motives else '#ff0000'
+        if not self.selected or not self.selected_motives:
+            return
 
-        main_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
-                            children=[validate_button])
-        if patient_box:
-            main_box.children.insert(0, patient_box)
-
-        self.main_window.content = main_box
-        self.main_window.show()
+        await self.find_centers()
 
     async def find_centers(self, button=None):
-        if self.patient_input and self.patient_input.value:
-            self.docto.patient = self.patients[self.patient_input.value]
+        """
+        Search a slot for each selected patient without one, in the same
+        sweeps.
+        """
+        from doctoshotgun_gui.engine import Search, Patient, NewEvent, UpdateEvent, FoundEvent, BookedEvent, ErrorEvent, StoppedEvent
+
+        self.docto.patient = self.selected[0]
 
+        self.show_screen('search', self.build_search_screen)
+        self.progress.clear()
+        self.progress.labels[-1].style.color = '#383D76'
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        self.engine.start(lambda event: loop.call_soon_threadsafe(queue.put_nowait, event),
+                          Search(self.cities, self.selected_motives, self.start_date, self.end_date, self.origin,
+                                 auto_book=self.auto_book_input.is_on,
+                                 patients=[Patient(patient, self.answers.get(patient)) for patient in self.selected]))
+
+        while True:
+            event = await queue.get()
+            if isinstance(event, NewEvent):
+                self.progress.add(event.text)
+            elif isinstance(event, UpdateEvent):
+                self.progress.append(event.text)
+            elif isinstance(event, FoundEvent):
+                self.progress.labels[-1].style.color = '#00ff00'
+                self.progress.append(event.text)
+                self.found_at = event.seen
+                self.docto.patient = event.patient
+                return self.confirm_center(event.appointment, event.center)
+            elif isinstance(event, BookedEvent):
+                self.selected.remove(event.patient)
+                if self.selected:
+                    self.progress.add('Booked for %(first_name)s %(last_name)s, searching for the others' % event.patient)
+                    continue
+                self.docto.patient = event.patient
+                return self.go_to_booked(event.appointment)
+            elif isinstance(event, ErrorEvent):
+                self.progress.render()
+                self.main_window.info_dialog('Oops', event.text)
+                return
+            elif isinstance(event, StoppedEvent):
+                return
+
+    def build_search_screen(self):
         intro1 = toga.Label('Alright!', style=Pack(font_weight='bold', font_size=16, color='#383D76'))
         intro2 = toga.Label('the app is searching for a slot!', style=Pack(font_size=14, color='#383D76'))
         intro_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_bottom=50),
@@ -303,138 +558,158 @@ class Doctoshotgun(toga.App):
                              children=[image])
 
         progress_title = toga.Label('Searching…', style=Pack(font_weight='bold', font_size=12, color='#383D76', flex=1, alignment='center'))
-        self.progress_line0 = toga.Label('', style=Pack(font_size=12, color='#ff0000', flex=1))
-        self.progress_line1 = toga.Label('', style=Pack(font_size=12, color='#ff0000', flex=1))
-        self.progress_line2 = toga.Label('', style=Pack(font_size=12, color='#ff0000', flex=1))
-        self.progress_line3 = toga.Label('', style=Pack(font_size=12, color='#383D76', flex=1))
+        # Older lines in red, the current one in blue.
+        progress_lines = [toga.Label('', style=Pack(font_size=12, color='#ff0000', flex=1))
+                          for x in range(self.PROGRESS_LINES - 1)]
+        progress_lines.append(toga.Label('', style=Pack(font_size=12, color='#383D76', flex=1)))
+        self.progress = ProgressLog(progress_lines)
         progress_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_bottom=50),
-                             children=[progress_title,
-                                       self.progress_line0,
-                                       self.progress_line1,
-                                       self.progress_line2,
-                                       self.progress_line3])
-
-
-        main_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
-                            children=[intro_box,
-                                      body_box,
-                                      image_box,
-                                      progress_box])
-
-        self.main_window.content = main_box
-        self.main_window.show()
-
-        def set_status(text):
-            for x in range(3):
-                getattr(self, 'progress_line%s' % x).text = getattr(self, 'progress_line%s' % (x+1)).text
-            self.progress_line3.text = text
+                             children=[progress_title] + progress_lines)
 
-        def append_status(text):
-            self.progress_line3.text += text
+        return toga.Box(style=Pack(direction=COLUMN, padding=20),
+                        children=[intro_box,
+                                  body_box,
+                                  image_box,
+                                  progress_box])
 
+    def build_appointment_boxes(self):
+        """
+        Boxes describing an appointment, and the function updating them
+        with another appointment.
+        """
+        vaccine = toga.Label('', style=Pack(font_weight='bold', color='#383D76'))
+        patient = toga.Label('', style=Pack(color='#383D76'))
+        vaccine_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_right=20, background_color='#EFF6FE'),
+                               children=[vaccine, patient])
 
-        motives = [self.docto.KEY_PFIZER_THIRD, self.docto.KEY_MODERNA_THIRD]
-        vaccine_list = [self.docto.vaccine_motives[motive] for motive in motives]
-        cities = ['paris']
+        # Native tables only create rows for the visible slots.
+        slots_table = toga.Table(headings=['Date', 'Time'],
+                                 style=Pack(padding_left=20, padding_right=20, height=150))
 
-        while True:
-            for center in self.docto.find_centers(cities, motives):
-                set_status('Center %(name_with_title)s (%(city)s)... ' % center)
-                await asyncio.sleep(0.1)
-
-                for appointment in self.docto.find_appointments(center, vaccine_list, self.start_date, self.end_date, [], False, True):
-                    await asyncio.sleep(0.1)
-                    self.progress_line3.style.color = '#00ff00'
-                    append_status('found!')
-                    return self.confirm_center(appointment)
-                else:
-                    append_status('not found')
+        center_name = toga.Label('', style=Pack(color='#383D76'))
+        address1 = toga.Label('', style=Pack(color='#383D76'))
+        address2 = toga.Label('', style=Pack(color='#383D76'))
+        address_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_right=20, padding_top=20),
+                               children=[center_name, address1, address2])
 
-                await asyncio.sleep(1)
+        def update(appointment, vaccine_name):
+            vaccine.text = '%s vaccine' % vaccine_name
+            patient.text = 'for %(first_name)s %(last_name)s' % self.docto.patient
 
-            await asyncio.sleep(5)
+            slots_table.data = [(slot.strftime('%d/%m/%Y'), slot.strftime('%H:%M')) for slot in appointment.slots]
 
-    def confirm_center(self, appointment):
-        intro = toga.Label('A slot has been found!', style=Pack(font_weight='bold', font_size=16, color='#383D76'))
-        intro_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_bottom=50),
-                             children=[intro])
-
-        vaccine = toga.Label('%s vaccine' % appointment.vaccine.replace('.*', ' '), style=Pack(font_weight='bold', color='#383D76'))
-        patient = toga.Label('for %(first_name)s %(last_name)s' % self.docto.patient, style=Pack(color='#383D76'))
-        #patient = toga.Label('for %(first_name)s %(last_name)s', style=Pack(color='#383D76'))
-        vaccine_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_right=20, background_color='#EFF6FE'),
-                               children=[vaccine, patient])
+            center_name.text = appointment.name
+            address1.text = appointment.address
+            address2.text = f'{appointment.zipcode} {appointment.city}'
 
+        return vaccine_box, slots_table, address_box, update
 
-        slots_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_right=20))
-        for slot in appointment.slots:
-            date = toga.Label(slot.strftime('%d/%m/%Y'), style=Pack(color='#383D76'))
-            date_box = toga.Box(style=Pack(direction=ROW, padding_right=20, background_color='#FCF4EF'),
-                                children=[date])
-            time = toga.Label(slot.strftime('%H:%M'), style=Pack(color='#383D76'))
-            time_box = toga.Box(style=Pack(direction=ROW, padding_left=20, background_color='#FCF4EF'),
-                                children=[time])
-            slot_box = toga.Box(style=Pack(direction=ROW), children=[date_box, time_box])
-            slots_box.children.append(slot_box)
+    def confirm_center(self, appointment, center):
+        from doctoshotgun_gui.engine import default_field_value
 
-        map_view = toga.WebView(style=Pack(flex=1))
-        map_view.set_content(None, f"""<html>
-<body style="margin:0px;padding:0px;overflow:hidden">
-    <iframe src="{appointment.map_url}" frameborder="0" style="overflow:hidden;height:100%;width:100%" height="100%" width="100%">
-    </iframe>
-</body>
-</html>""")
-        map_box = toga.Box(style=Pack(padding_left=20, padding_right=20, flex=1, height=200),
-                           children=[map_view])
+        self.appointment = appointment
+        self.center = center
+        self.show_screen('confirm', self.build_confirm_screen)
+        self.update_confirm(appointment, appointment.vaccine.replace('.*', ' '))
 
-        center_name = toga.Label(appointment.name, style=Pack(color='#383D76'))
-        address1 = toga.Label(appointment.address, style=Pack(color='#383D76'))
-        address2 = toga.Label(f'{appointment.zipcode} {appointment.city}', style=Pack(color='#383D76'))
-        address_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_right=20, padding_top=20),
-                               children=[center_name, address1, address2])
+        # The map of the previous appointment.
+        if self.map_view is not None:
+            self.map_box.remove(self.map_view)
+            self.map_box.add(self.map_image)
+            self.map_view = None
+        self.map_image.image = None
+        asyncio.get_event_loop().create_task(self.load_map(appointment, center))
 
         self.custom_fields = {}
-        fields_box = toga.Box(style=Pack(padding_left=20, padding_top=20))
+        for child in list(self.fields_box.children):
+            self.fields_box.remove(child)
 
+        answers = self.answers.get(self.docto.patient)
         for field in appointment.custom_fields:
-            if field['id'] == 'cov19':
-                value = 'Non'
-            elif field['placeholder']:
-                value = field['placeholder']
-            else:
+            value = answers.get(field['id'], default_field_value(field))
+            if value is None:
                 label = toga.Label(field['label'], style=Pack(padding_top=20, color='#383D76'))
                 if field.get('options'):
                     value = toga.Selection(items=field['options'], style=Pack(padding_top=10, color='#383D76'))
                 else:
                     value = toga.TextInput(placeholder=field['placeholder'], style=Pack(color='#383D76'))
-                fields_box.children.append(label)
-                fields_box.children.append(value)
+                self.fields_box.add(label)
+                self.fields_box.add(value)
 
             self.custom_fields[field['id']] = value
 
+    async def load_map(self, appointment, center):
+        """
+        Show the static map of the center, in the background once the
+        booking controls are shown.
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            path = await loop.run_in_executor(None, self.maps.get, center)
+        except OSError:
+            # The full map can still be shown with the button.
+            return
+
+        if path is not None and self.appointment is appointment and self.map_view is None:
+            self.map_image.image = toga.Image(path)
+
+    def show_map_page(self, widget):
+        if self.map_view is None:
+            self.map_view = toga.WebView(style=Pack(flex=1))
+            self.map_box.remove(self.map_image)
+            self.map_box.add(self.map_view)
+
+        self.map_view.set_content(None, f"""<html>
+<body style="margin:0px;padding:0px;overflow:hidden">
+    <iframe src="{self.appointment.map_url}" frameborder="0" style="overflow:hidden;height:100%;width:100%" height="100%" width="100%">
+    </iframe>
+</body>
+</html>""")
+
+    def build_confirm_screen(self):
+        intro = toga.Label('A slot has been found!', style=Pack(font_weight='bold', font_size=16, color='#383D76'))
+        intro_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_bottom=50),
+                             children=[intro])
+
+        vaccine_box, slots_table, address_box, self.update_confirm = self.build_appointment_boxes()
+
+        # The web map is only loaded on demand.
+        self.map_image = toga.ImageView(style=Pack(flex=1))
+        self.map_box = toga.Box(style=Pack(padding_left=20, padding_right=20, flex=1, height=200),
+                                children=[self.map_image])
+        map_button = toga.Button('Show map',
+                                 style=Pack(padding_left=20, padding_right=20, background_color='#ffffff', color='#9B9EBA'),
+                                 on_press=self.show_map_page)
+
+        self.fields_box = toga.Box(style=Pack(padding_left=20, padding_top=20))
 
         validate_button = toga.Button('Book it now',
                                       style=Pack(padding=20, background_color='#383D76', color='#ffffff'),
-                                      on_press=lambda _: self.book_appointment(appointment))
+                                      on_press=lambda _: self.book_appointment(self.appointment))
 
         cancel_button = toga.Button('Search again',
                                       style=Pack(padding=20, background_color='#ffffff', color='#9B9EBA'),
-                                      on_press=self.find_centers)
-
-        main_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
-                            children=[intro_box,
-                                      vaccine_box,
-                                      slots_box,
-                                      map_box,
-                                      address_box,
-                                      fields_box,
-                                      validate_button,
-                                      cancel_button])
-
-        self.main_window.content = main_box
-        self.main_window.show()
-
-    def book_appointment(self, appointment):
+                                      on_press=self.search_again)
+
+        return toga.Box(style=Pack(direction=COLUMN, padding=20),
+                        children=[intro_box,
+                                  vaccine_box,
+                                  slots_table,
+                                  self.map_box,
+                                  map_button,
+                                  address_box,
+                                  self.fields_box,
+                                  validate_button,
+                                  cancel_button])
+
+    async def search_again(self, widget):
+        from doctoshotgun_gui.slots import SlotIndex
+
+        # Don't stop on this slot again.
+        self.engine.slots.mark(self.center, self.appointment, SlotIndex.REJECTED)
+        await self.find_centers()
+
+    async def book_appointment(self, appointment):
         custom_fields = {}
         for key, value in self.custom_fields.items():
             if isinstance(value, toga.Widget):
@@ -442,119 +717,55 @@ class Doctoshotgun(toga.App):
             else:
                 custom_fields[key] = value
 
-        r = self.docto.book_appointment(appointment, custom_fields)
+        r = await self.run(self.docto.book_appointment, appointment, custom_fields)
 
         if not r:
+            from doctoshotgun_gui.slots import SlotIndex
+
+            self.engine.slots.mark(self.center, appointment, SlotIndex.FAILED)
             self.main_window.info_dialog('Oops', 'Unable to book your slot')
             return
 
+        if self.found_at is not None:
+            self.engine.metrics.observe('found_to_booked_seconds', time.monotonic() - self.found_at, mode='manual')
+        self.answers.update(self.docto.patient, custom_fields)
+        self.selected.remove(self.docto.patient)
+
+        self.go_to_booked(appointment)
+
+    def go_to_booked(self, appointment):
+        self.show_screen('booked', self.build_booked_screen)
+        self.update_booked(appointment, appointment.vaccine.replace('.*', ' ').title())
+        self.next_button.style.visibility = 'visible' if self.selected else 'hidden'
+
+    def build_booked_screen(self):
         intro = toga.Label('Your slot is booked!', style=Pack(font_weight='bold', font_size=16, color='#383D76'))
         intro_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_bottom=50),
                              children=[intro])
 
-        vaccine = toga.Label('%s vaccine' % appointment.vaccine.replace('.*', ' ').title(), style=Pack(font_weight='bold', color='#383D76'))
-        patient = toga.Label('for %(first_name)s %(last_name)s' % self.docto.patient, style=Pack(color='#383D76'))
-        vaccine_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_top=70, padding_right=20, background_color='#EFF6FE'),
-                               children=[vaccine, patient])
-
-        slots_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_right=20))
-        for slot in appointment.slots:
-            date = toga.Label(slot.strftime('%d/%m/%Y'), style=Pack(color='#383D76'))
-            date_box = toga.Box(style=Pack(direction=ROW, padding_right=20, background_color='#FCF4EF'),
-                                children=[date])
-            time = toga.Label(slot.strftime('%H:%M'), style=Pack(color='#383D76'))
-            time_box = toga.Box(style=Pack(direction=ROW, padding_left=20, background_color='#FCF4EF'),
-                                children=[time])
-            slot_box = toga.Box(style=Pack(direction=ROW), children=[date_box, time_box])
-            slots_box.children.append(slot_box)
-
-        center_name = toga.Label(appointment.name, style=Pack(color='#383D76'))
-        address1 = toga.Label(appointment.address, style=Pack(color='#383D76'))
-        address2 = toga.Label(f'{appointment.zipcode} {appointment.city}', style=Pack(color='#383D76'))
-        address_box = toga.Box(style=Pack(direction=COLUMN, padding_left=20, padding_right=20, padding_top=20),
-                               children=[center_name, address1, address2])
+        vaccine_box, slots_table, address_box, self.update_booked = self.build_appointment_boxes()
 
         validate_button = toga.Button('Open Doctolib',
                                       style=Pack(padding=20, background_color='#383D76', color='#ffffff'),
                                       on_press=lambda _: webbrowser.open(self.docto.BASEURL))
 
+        self.next_button = toga.Button('Search for the other patients',
+                                       style=Pack(padding=20, background_color='#383D76', color='#ffffff'),
+                                       on_press=self.find_centers)
+
         close_button = toga.Button('Close app',
                                    style=Pack(padding=20, background_color='#ffffff', color='#9B9EBA'),
                                    on_press=lambda _: self.exit())
 
-        main_box = toga.Box(style=Pack(direction=COLUMN, padding=20),
-                            children=[intro_box,
-                                      vaccine_box,
-                                      slots_box,
-                                      address_box,
-                                      validate_button,
-                                      close_button])
-
-        self.main_window.content = main_box
-        self.main_window.show()
-
-
-        #print('go go go')
-        #import janus
-        #import threading
-
-        #loop = self._impl.loop
-        ##loop = asyncio.get_event_loop()
-
-        ##queue = janus.Queue()
-        #queue = asyncio.Queue()
-        #threading.Thread(target=self.do_things, args=(queue,)).start()
-
-        ##with concurrent.futures.ThreadPoolExecutor() as pool:
-        ##    queue = asyncio.Queue()
+        return toga.Box(style=Pack(direction=COLUMN, padding=20),
+                        children=[intro_box,
+                                  vaccine_box,
+                                  slots_table,
+                                  address_box,
+                                  validate_button,
+                                  self.next_button,
+                                  close_button])
 
-        ##    task = loop.run_in_executor(pool, self.do_things, queue.sync_q)
-        #while True:
-        #    print('wait for event')
-        #    event = await queue.get()
-
-        #    print('got an event')
-        #    if isinstance(event, NewEvent):
-        #        for x in range(3):
-        #            getattr(self, 'progress_line%s' % x).text = getattr(self, 'progress_line%s' % (x+1)).text
-        #        self.progress_line3.text = event.text
-        #    elif isinstance(event, UpdateEvent):
-        #        self.progress_line3.text += event.text
-        #    elif isinstance(event, FoundEvent):
-        #        break
-
-
-    def do_things(self, queue):
-        print('do things')
-        try:
-            from time import sleep
-            import requests
-            for x in range(5):
-                print('first sleep')
-                requests.get('https://www.google.com')
-                print('send center')
-                queue.put_nowait(NewEvent('Centre %s...' % x))
-                sleep(2)
-                print('send not found')
-                queue.put_nowait(UpdateEvent(' not found'))
-            queue.put_nowait(FoundEvent())
-        finally:
-            print('end')
-
-class UpdateEvent:
-    text: str
-
-    def __init__(self, text):
-        self.text = text
-
-class NewEvent:
-    text: str
-
-    def __init__(self, text):
-        self.text = text
-
-class FoundEvent:
-    text: str
 
 def main():
     import logging
@@ -0,0 +1,142 @@
+"""
+Time-to-slot benchmark.
+
+Runs the search engine against a local replay of a cassette recorded with
+the headless mode's "record" option::
+
+    python -m doctoshotgun_gui.bench cassette.jsonl --latency 0.05 --slot-after 10
+
+and prints a JSON report. With --baseline, a previous report, it exits with
+an error when a metric is worse than the baseline by more than --tolerance.
+"""
+import argparse
+import json
+import queue
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from doctoshotgun_gui.cache import CenterCache
+from doctoshotgun_gui.cli import COUNTRIES, MOTIVES
+from doctoshotgun_gui.engine import Search, SearchEngine, FoundEvent, ErrorEvent, StoppedEvent, SweepEvent
+from doctoshotgun_gui.replay import StandIn
+from doctoshotgun_gui.scheduler import Scheduler
+
+# Metrics compared with the baseline, and whether lower is better.
+METRICS = {'time_to_first_slot': True,
+           'sweep_duration': True,
+           'peak_memory': True,
+           'probes_per_second': False,
+          }
+
+
+def run_once(args):
+    standin = StandIn(args.cassette, args.latency, args.jitter, args.error_rate, args.slot_after).start()
+    engine = SearchEngine(concurrency=args.concurrency, scheduler=Scheduler(args.rate),
+                          cache=CenterCache(), transports=[standin])
+    try:
+        klass, _ = COUNTRIES[args.country]
+        engine.docto = klass('bench', 'bench')
+        engine.docto.patient = engine.docto.get_patients()[0]
+
+        motives = [getattr(engine.docto, motive) for motive in MOTIVES]
+        search = Search(args.cities, motives, date.today(), date.today() + relativedelta(days=30))
+        events = queue.Queue()
+        sweeps = []
+        found = None
+
+        tracemalloc.start()
+        started = time.monotonic()
+        engine.start(events.put, search)
+        while True:
+            try:
+                event = events.get(timeout=max(0, started + args.timeout - time.monotonic()))
+            except queue.Empty:
+                engine.cancel()
+                continue
+
+            if isinstance(event, SweepEvent):
+                sweeps.append(event.duration)
+            elif isinstance(event, FoundEvent):
+                found = time.monotonic() - started
+                break
+            elif isinstance(event, ErrorEvent):
+                raise event.exception
+            elif isinstance(event, StoppedEvent):
+                break
+
+        elapsed = time.monotonic() - started
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        engine.shutdown()
+        standin.stop()
+
+    return {'time_to_first_slot': found,
+            'sweep_duration': statistics.mean(sweeps) if sweeps else None,
+            'sweeps': len(sweeps),
+            'probes': search.probes,
+            'probes_per_second': search.probes / elapsed,
+            'requests': standin.requests,
+            'requests_per_second': standin.requests / elapsed,
+            'errors': standin.errors,
+            'peak_memory': peak_memory,
+           }
+
+
+def summarize(runs):
+    report = {'runs': len(runs)}
+    for key in runs[0]:
+        values = [run[key] for run in runs if run[key] is not None]
+        report[key] = statistics.median(values) if values else None
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    for key, lower_is_better in METRICS.items():
+        value, reference = report.get(key), baseline.get(key)
+        if value is None or not reference:
+            continue
+        if lower_is_better and value > reference * (1 + tolerance) or \
+           not lower_is_better and value < reference * (1 - tolerance):
+            yield key, reference, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the slot search against a replay of Doctolib')
+    parser.add_argument('cassette', help='exchanges recorded with the "record" option')
+    parser.add_argument('--country', default='France', choices=list(COUNTRIES))
+    parser.add_argument('--cities', nargs='+', default=['paris'])
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--rate', type=float, default=None, help='initial requests per second')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra latency, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='part of the requests answered by a 503')
+    parser.add_argument('--slot-after', type=float, default=None, help='seconds before slots appear')
+    parser.add_argument('--timeout', type=float, default=300, help='give up a run after this many seconds')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--baseline', help='previous report to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    report = summarize([run_once(args) for _ in range(args.runs)])
+    print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+
+        failed = False
+        for key, reference, value in regressions(report, baseline, args.tolerance):
+            print('Regression on %s: %s -> %s' % (key, reference, value), file=sys.stderr)
+            failed = True
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
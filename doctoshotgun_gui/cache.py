@@ -0,0 +1,106 @@
+"""
+Cache of the centers found for a search.
+
+Centers offering a motive in a city barely change, so after the first
+sweep they are read from here instead of paging again through the search
+results. Entries older than the TTL are still used, while a fresh list is
+fetched in the background.
+
+Search results are kept as :class:`Center` records, with the few fields
+the search uses.
+"""
+import json
+import threading
+import time
+
+from doctoshotgun_gui.files import read_json, write_atomic
+
+
+class Center:
+    """
+    Compact search result of a center, read like the dict it comes from.
+    """
+
+    __slots__ = ('id', 'url', 'name_with_title', 'city', 'zipcode', 'address', 'position')
+
+    def __init__(self, result):
+        for name in self.__slots__:
+            setattr(self, name, result.get(name))
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self.__slots__ else default
+
+    def keys(self):
+        return self.__slots__
+
+
+class CenterCache:
+    FILENAME = 'centers.json'
+    TTL = 3600
+
+    def __init__(self, path=None, ttl=None):
+        """
+        :param path: file where the cache persists, None to keep it in memory
+        :param ttl: seconds before an entry must be refreshed
+        """
+        if ttl is not None:
+            self.TTL = ttl
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    @staticmethod
+    def key(baseurl, cities, motives):
+        return '%s|%s|%s' % (baseurl, ','.join(sorted(cities)), ','.join(sorted(motives)))
+
+    def load(self):
+        entries = read_json(self.path)
+        for entry in entries.values():
+            entry['centers'] = [Center(center) for center in entry['centers']]
+        return entries
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            data = json.dumps(self.entries, default=dict)
+
+        write_atomic(self.path, data)
+
+    def get(self, key):
+        """
+        :returns: the cached centers, or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return entry['centers']
+
+    def is_stale(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry is None or time.time() - entry['time'] > self.TTL
+
+    def put(self, key, centers, complete=True):
+        """
+        :param complete: False if the listing stopped early, then the centers
+                         are kept stale, unless a list is already cached
+        """
+        if not centers:
+            # Most likely blocked, there is always a center around.
+            return
+
+        centers = [center if isinstance(center, Center) else Center(center) for center in centers]
+        with self.lock:
+            if not complete and key in self.entries:
+                return
+            self.entries[key] = {'time': time.time() if complete else 0, 'centers': centers}
+        self.save()
@@ -0,0 +1,365 @@
+"""
+Headless mode.
+
+Runs the same steps as the GUI, without a display, from a JSON config file::
+
+    {"country": "France", "zip": "75011", "radius": 10,
+     "start_date": "01/12/2021", "end_date": "31/12/2021",
+     "login": "example@gmail.com", "password": "…",
+     "patient": "Jean Dupont", "book": true}
+
+Cities within "radius" km of the ZIP code are searched. They are found in
+the postal code index of the country (see :mod:`doctoshotgun_gui.geo`); if
+it has not been built, set "cities" to the Doctolib names of the cities.
+
+Vaccines searched are set by "motives", a list of motive keys of the
+browser classes, boosters of Pfizer and Moderna by default::
+
+    "motives": ["KEY_PFIZER", "KEY_PFIZER_SECOND"]
+
+Each center is asked for slots by one query for each kind of dose. To
+split these queries, in queries run at once, set "window" to the number of
+days fetched by one query, and "motive_group" to the number of motives.
+
+To search for several patients of the account at once, set "patients" to a
+list of names, or of objects with a "name" and optional "start_date" and
+"end_date" narrowing the dates of the search for this patient. The search
+goes on until each one has a slot.
+
+With "book", the first slot found is booked right away by the search engine,
+answering the booking form from "custom_fields" and the answers saved for
+the patient. Otherwise, the user is asked for confirmation; a slot turned
+down is not proposed again and the search goes on. Without a terminal to
+ask, the search stops at the first slot found, with exit code 2, for the
+user to book it. A slot which could not be booked ends the run with exit
+code 1.
+
+Slots found are also notified on the desktop, unless "alert_desktop" is
+false, and sent to the local "alert_webhook" and "alert_command" if set
+(see :mod:`doctoshotgun_gui.alerts`).
+
+Set "record" to a file name to save the HTTP exchanges with Doctolib in a
+cassette for :mod:`doctoshotgun_gui.bench`.
+
+Metrics are served in the Prometheus format on "metrics_port", and/or
+written as JSON to "metrics_file" every "metrics_interval" seconds. Set
+"profile" to a file name to save the cProfile stats of the first sweep.
+
+Progress is logged on stdout as JSON lines. Searches are also written to
+journal.jsonl, next to the sessions, so an interrupted search resumes
+where it stopped (see :mod:`doctoshotgun_gui.journal`).
+"""
+import argparse
+import json
+import os
+import queue
+import sys
+import time
+from datetime import datetime, date
+from pathlib import Path
+
+from dateutil.relativedelta import relativedelta
+
+from woob.exceptions import ScrapingBlocked, BrowserInteraction
+from doctoshotgun.doctolib import DoctolibFR, DoctolibDE
+
+from doctoshotgun_gui import geo
+from doctoshotgun_gui.alerts import Alerts
+from doctoshotgun_gui.cache import CenterCache
+from doctoshotgun_gui.answers import AnswerStore
+from doctoshotgun_gui.engine import (Search, SearchEngine, Patient, default_field_value,
+                                     FoundEvent, BookedEvent, ErrorEvent, StoppedEvent)
+from doctoshotgun_gui.journal import Journal
+from doctoshotgun_gui.metrics import METRICS
+from doctoshotgun_gui.replay import Recorder
+from doctoshotgun_gui.sessions import SessionStore
+from doctoshotgun_gui.slots import SlotIndex
+from doctoshotgun_gui.stats import CenterStats
+
+
+COUNTRIES = {'France': (DoctolibFR, 'FR'),
+             'Germany': (DoctolibDE, 'DE'),
+            }
+
+# Single session file of previous versions.
+STATE_FILENAME = 'state.json'
+# Same place as the GUI, so both share the Doctolib sessions.
+DATA_DIR = Path.home() / '.local' / 'share' / 'doctoshotgun_gui'
+
+MOTIVES = ['KEY_PFIZER_THIRD', 'KEY_MODERNA_THIRD']
+
+
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.strptime(value, '%d/%m/%Y').date()
+
+
+def log(event, **fields):
+    line = {'time': datetime.now().isoformat(timespec='seconds'), 'event': event}
+    line.update(fields)
+    print(json.dumps(line, default=str), flush=True)
+
+
+class Headless:
+    def __init__(self, config, code=None, code_file=None):
+        self.config = config
+        self.code = code
+        self.code_file = code_file
+        self.data_dir = Path(config.get('data_dir', DATA_DIR)).expanduser()
+
+        transports = []
+        if config.get('record'):
+            transports.append(Recorder(config['record']))
+
+        self.sessions = SessionStore(self.data_dir / SessionStore.FILENAME,
+                                     legacy_path=self.data_dir / STATE_FILENAME)
+        self.engine = self.new_engine(transports)
+        if config.get('profile'):
+            self.engine.profile_next_sweep(config['profile'])
+        self.answers = AnswerStore(self.data_dir / AnswerStore.FILENAME)
+        self.docto = None
+        # Patients without a slot yet.
+        self.patients = []
+
+    def new_engine(self, transports):
+        return self.split_queries(SearchEngine(concurrency=self.config.get('concurrency'),
+                            cache=CenterCache(self.data_dir / CenterCache.FILENAME),
+                            sessions=self.sessions,
+                            slots=SlotIndex(self.data_dir / SlotIndex.FILENAME),
+                            journal=Journal(self.data_dir / Journal.FILENAME),
+                            stats=CenterStats(self.data_dir / CenterStats.FILENAME),
+                            transports=transports, alerts=Alerts.from_config(self.config),
+                            long_run=True))
+
+    def split_queries(self, engine):
+        engine.window = self.config.get('window')
+        engine.motive_group = self.config.get('motive_group')
+        return engine
+
+    def read_code(self):
+        if self.code:
+            return self.code
+
+        if self.code_file:
+            log('otp', text='Waiting for the code in %s' % self.code_file)
+            while not os.path.exists(self.code_file):
+                time.sleep(1)
+            with open(self.code_file) as fp:
+                code = fp.read().strip()
+            os.remove(self.code_file)
+            return code
+
+        if not sys.stdin.isatty():
+            raise SystemExit('An auth code is needed, use --code or --code-file')
+        return input('Enter the code received at your email address from Doctolib: ').strip()
+
+    def login(self, klass):
+        self.docto = self.engine.docto = klass(self.config['login'], self.config['password'])
+        self.sessions.restore(self.docto)
+        try:
+            if not self.docto.do_login():
+                log('error', text='Invalid login or password')
+                return False
+        except ScrapingBlocked as e:
+            log('error', text=str(e))
+            return False
+        except BrowserInteraction:
+            log('otp', text='Auth code sent by Doctolib')
+            if not self.docto.do_otp(self.read_code()):
+                log('error', text='Invalid auth code')
+                return False
+
+        # Save storage to prevent doing OTP next time.
+        self.sessions.save(self.docto)
+        log('login', text='Logged in')
+        return True
+
+    def select_patients(self):
+        """
+        Set :attr:`patients` to the :class:`Patient` list to search for.
+        """
+        patients = {'%(first_name)s %(last_name)s' % patient: patient for patient in self.docto.get_patients()}
+        if not patients:
+            log('error', text='No patient on this account')
+            return False
+
+        selected = self.config.get('patients')
+        if selected is None:
+            selected = [self.config.get('patient') or list(patients.keys())[0]]
+
+        self.patients = []
+        for item in selected:
+            if not isinstance(item, dict):
+                item = {'name': item}
+            if item['name'] not in patients:
+                log('error', text='Unknown patient %s' % item['name'], patients=list(patients.keys()))
+                return False
+
+            patient = patients[item['name']]
+            self.patients.append(Patient(patient, self.get_answers(patient),
+                                         parse_date(item.get('start_date')), parse_date(item.get('end_date'))))
+            log('patient', text=item['name'])
+
+        self.docto.patient = self.patients[0].patient
+        return True
+
+    def get_answers(self, patient):
+        answers = self.answers.get(patient)
+        answers.update(self.config.get('custom_fields', {}))
+        return answers
+
+    def new_search(self, country_code, centers=None):
+        """
+        :returns: the :class:`Search` of the config, for the patients without
+                  a slot yet, or None
+        """
+        start_date = parse_date(self.config.get('start_date')) or date.today()
+        end_date = parse_date(self.config.get('end_date')) or start_date + relativedelta(days=30)
+
+        origin, cities = geo.find_cities(country_code, self.config['zip'], self.config.get('radius', 10),
+                                         self.config.get('max_cities', 20))
+        if cities is None:
+            cities = self.config.get('cities')
+        if cities is None:
+            log('error', text='No postal code index for %s, build it with "python -m doctoshotgun_gui.geo %s" '
+                              'or set "cities"' % (country_code, country_code))
+            return None
+        if not cities:
+            log('error', text='Unknown ZIP code %s' % self.config['zip'])
+            return None
+        log('cities', cities=cities)
+
+        motives = [getattr(self.docto, motive) for motive in self.config.get('motives', MOTIVES)]
+
+        return Search(cities, motives, start_date, end_date, origin,
+                      auto_book=bool(self.config.get('book')),
+                      patients=list(self.patients), centers=centers)
+
+    def search(self, country_code):
+        """
+        Search until a slot is found for a patient, logging the ones booked
+        on the way.
+
+        :returns: the :class:`FoundEvent` or :class:`BookedEvent` ending the
+                  search, or None
+        """
+        search = self.new_search(country_code)
+        if search is None:
+            return None
+
+        events = queue.Queue()
+        self.engine.start(events.put, search)
+        while True:
+            event = events.get()
+            log(type(event).__name__, text=event.text)
+            if isinstance(event, BookedEvent):
+                self.booked(event)
+                if self.patients:
+                    continue
+            if isinstance(event, (FoundEvent, BookedEvent)):
+                return event
+            if isinstance(event, (ErrorEvent, StoppedEvent)):
+                return None
+
+    def ask(self, question):
+        if not sys.stdin.isatty():
+            return None
+        return input(question).strip()
+
+    def log_appointment(self, event, appointment, **fields):
+        log(event, center=appointment.name, address=appointment.address, zipcode=appointment.zipcode,
+            city=appointment.city, vaccine=appointment.vaccine, slots=[slot.isoformat() for slot in appointment.slots],
+            **fields)
+
+    def booked(self, event):
+        self.patients = [patient for patient in self.patients if patient.patient is not event.patient]
+        self.log_appointment('booked', event.appointment, url=self.docto.BASEURL, latency=event.latency,
+                             patient='%(first_name)s %(last_name)s' % event.patient)
+
+    def book(self, center, appointment, patient):
+        """
+        :returns: the exit code if the run stops there, 2 if nobody is there
+                  to confirm the slot and 1 if it could not be booked, None
+                  to search again
+        """
+        self.docto.patient = patient.patient
+        self.log_appointment('found', appointment, patient='%(first_name)s %(last_name)s' % patient.patient)
+
+        answer = self.ask('Book it? (y/N) ')
+        if answer is None:
+            # Left as seen, the user may still book it on Doctolib.
+            log('unconfirmed', text='Nobody to confirm the slot, book it on Doctolib or set "book"',
+                url=self.docto.BASEURL)
+            return 2
+        if answer.lower() != 'y':
+            # Not proposed again, by this run or the next ones.
+            self.engine.slots.mark(center, appointment, SlotIndex.REJECTED)
+            log('skipped')
+            return None
+
+        answers = patient.answers
+        custom_fields = {}
+        for field in appointment.custom_fields:
+            value = answers.get(field['id'], default_field_value(field))
+            if value is None:
+                value = self.ask('%s: ' % field['label'])
+            if value is None:
+                log('error', text='No answer to %s in custom_fields' % field['id'])
+                return 1
+            custom_fields[field['id']] = value
+
+        if not self.docto.book_appointment(appointment, custom_fields):
+            self.engine.slots.mark(center, appointment, SlotIndex.FAILED)
+            log('error', text='Unable to book the slot')
+            return 1
+
+        self.answers.update(self.docto.patient, custom_fields)
+        self.patients.remove(patient)
+        self.log_appointment('booked', appointment, url=self.docto.BASEURL,
+                             patient='%(first_name)s %(last_name)s' % patient.patient)
+        return None
+
+    def run(self):
+        klass, country_code = COUNTRIES[self.config.get('country', 'France')]
+        try:
+            if not self.login(klass) or not self.select_patients():
+                return 1
+
+            while self.patients:
+                event = self.search(country_code)
+                if event is None:
+                    return 1
+                if isinstance(event, FoundEvent):
+                    patient = next(patient for patient in self.patients if patient.patient is event.patient)
+                    code = self.book(event.center, event.appointment, patient)
+                    if code is not None:
+                        return code
+            return 0
+        finally:
+            self.engine.shutdown()
+            if self.docto:
+                self.sessions.save(self.docto)
+            self.sessions.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Book vaccine slots on Doctolib, without a display')
+    parser.add_argument('config', help='JSON config file')
+    parser.add_argument('--code', help='auth code received from Doctolib')
+    parser.add_argument('--code-file', help='file to read the auth code from, once it exists')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+
+    if config.get('metrics_port'):
+        METRICS.serve(config['metrics_port'])
+    if config.get('metrics_file'):
+        METRICS.dump_periodically(config['metrics_file'], config.get('metrics_interval', 60))
+
+    return Headless(config, args.code, args.code_file).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
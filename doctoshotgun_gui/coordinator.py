@@ -0,0 +1,366 @@
+"""
+Search spread over several accounts and processes.
+
+One search is bound by the rate limit of one account and by one core. The
+coordinator splits the centers of the search into shards, one per account,
+each one searched by a worker process logged in with its own session::
+
+    python -m doctoshotgun_gui.coordinator config.json
+
+The config is the one of :mod:`doctoshotgun_gui.cli`, with the login,
+password and patients given by account instead::
+
+    {"country": "France", "zip": "75011", "radius": 10,
+     "accounts": [{"login": "a@example.com", "password": "…",
+                   "patients": ["Jean Dupont"]},
+                  {"login": "b@example.com", "password": "…"}]}
+
+Accounts are logged in one after the other by the coordinator first, so it
+can ask for auth codes, then workers reuse the saved sessions. Slots are
+always booked automatically, by the worker of the account of the patient,
+so each patient is booked once: a patient can't be listed by two accounts.
+
+Each worker searches its shard for the patients of every account. A slot
+found for a patient of another account is reported to the coordinator,
+which asks the worker of that account to probe the center before the
+others, and book it.
+
+Shards are weighted by the number of centers each worker probes per
+second. They are split again when a worker is throttled by Doctolib, once
+every worker has completed a sweep, and when a worker has booked a slot for
+all its patients.
+"""
+import argparse
+import json
+import multiprocessing
+import queue
+import sys
+import threading
+
+from doctoshotgun_gui.alerts import Alerts
+from doctoshotgun_gui.cli import COUNTRIES, Headless, log
+from doctoshotgun_gui.engine import (SearchEngine, Patient, FoundEvent, BookedEvent, ErrorEvent, StoppedEvent,
+                                     SweepEvent, ThrottledEvent)
+from doctoshotgun_gui.sessions import SessionStore
+from doctoshotgun_gui.slots import SlotIndex
+
+
+def split(centers, weights):
+    """
+    Spread centers over shards in proportion to weights. Each shard takes
+    centers in turn, so they all get near and far ones.
+
+    :returns: one list of centers per weight
+    """
+    shards = [[] for weight in weights]
+    for center in centers:
+        index = min(range(len(weights)), key=lambda i: (len(shards[i]) + 1) / weights[i])
+        shards[index].append(center)
+    return shards
+
+
+class SessionRelay:
+    """
+    Sessions of a worker, sent to the coordinator which saves them.
+    """
+
+    def __init__(self, state, results):
+        self.state = state
+        self.results = results
+
+    def restore(self, browser):
+        browser.load_state(self.state)
+
+    def save(self, browser):
+        self.results.put(('session', SessionStore.key(browser), browser.dump_state()))
+
+    def close(self):
+        pass
+
+
+class Worker(Headless):
+    """
+    Searches a shard of the centers, in its own process.
+
+    Files of the data directory are written by the coordinator only, so the
+    engine of a worker keeps its state in memory.
+
+    :param others: :class:`Patient` list of the other accounts, with the
+                   index of their worker as owner
+    """
+
+    def __init__(self, index, config, state, others, commands, results):
+        self.index = index
+        self.state = state
+        self.others = others
+        self.commands = commands
+        self.results = results
+        self.current = None
+        # Names of the patients of other accounts booked since.
+        self.booked_elsewhere = set()
+        super().__init__(config)
+
+    def new_engine(self, transports):
+        self.sessions = SessionRelay(self.state, self.results)
+        return self.split_queries(SearchEngine(concurrency=self.config.get('concurrency'),
+                                               sessions=self.sessions, transports=transports,
+                                               alerts=Alerts.from_config(self.config), long_run=True))
+
+    def new_search(self, country_code, centers=None):
+        search = super().new_search(country_code, centers)
+        if search is not None:
+            # After the patients of the account, booked here when a slot
+            # fits both.
+            search.patients += [patient for patient in self.others
+                                if '%(first_name)s %(last_name)s' % patient.patient not in self.booked_elsewhere]
+        return search
+
+    def read_code(self):
+        raise SystemExit('Worker %d: an auth code is needed, log in with the headless mode first' % self.index)
+
+    def listen(self):
+        while True:
+            command = self.commands.get()
+            if command[0] == 'centers':
+                # Read by the next sweep.
+                self.current.centers = command[1]
+            elif command[0] == 'probe':
+                self.current.priority.append(command[1])
+            elif command[0] == 'booked':
+                self.booked_elsewhere.add(command[1])
+                for patient in list(self.current.patients):
+                    if patient.owner is not None and \
+                       '%(first_name)s %(last_name)s' % patient.patient == command[1]:
+                        self.current.patients.remove(patient)
+            elif command[0] == 'stop':
+                self.engine.cancel()
+                return
+
+    def run(self, centers):
+        klass, country_code = COUNTRIES[self.config.get('country', 'France')]
+        try:
+            if not self.login(klass) or not self.select_patients():
+                return 1
+
+            events = queue.Queue()
+            self.current = self.new_search(country_code, centers)
+            if self.current is None:
+                return 1
+            self.engine.start(events.put, self.current)
+            threading.Thread(target=self.listen, name='doctoshotgun-commands', daemon=True).start()
+
+            while True:
+                event = events.get()
+                log(type(event).__name__, worker=self.index, text=event.text)
+                if isinstance(event, ThrottledEvent):
+                    self.results.put(('throttled', self.index))
+                elif isinstance(event, SweepEvent):
+                    self.results.put(('sweep', self.index, event.centers, event.duration))
+                elif isinstance(event, BookedEvent):
+                    self.booked(event)
+                    self.results.put(('booked', self.index, '%(first_name)s %(last_name)s' % event.patient))
+                    if not self.patients:
+                        return 0
+                elif isinstance(event, FoundEvent):
+                    owner = next((patient.owner for patient in self.others if patient.patient is event.patient),
+                                 None)
+                    if owner is not None:
+                        self.log_appointment('found', event.appointment, worker=self.index,
+                                             text='Sent to worker %d' % owner)
+                        self.results.put(('hit', self.index, owner, event.center))
+                    else:
+                        # Nobody can fill the booking form here.
+                        self.log_appointment('found', event.appointment, worker=self.index,
+                                             text='Unable to fill the booking form, book it on Doctolib')
+                    # Not stopped at again by this worker.
+                    self.engine.slots.mark(event.center, event.appointment, SlotIndex.FAILED)
+                    priority = self.current.priority
+                    self.current = self.new_search(country_code, self.current.centers)
+                    self.current.priority = priority
+                    self.engine.start(events.put, self.current)
+                elif isinstance(event, ErrorEvent):
+                    return 1
+                elif isinstance(event, StoppedEvent):
+                    return 0
+        finally:
+            self.engine.shutdown()
+            if self.docto:
+                self.sessions.save(self.docto)
+
+
+def work(index, config, state, others, centers, commands, results):
+    """
+    Entry point of worker processes.
+    """
+    code = 1
+    try:
+        code = Worker(index, config, state, others, commands, results).run(centers)
+    finally:
+        results.put(('done', index, code))
+
+
+class Coordinator(Headless):
+    """
+    Logs in every account, then runs and balances the workers.
+    """
+
+    def __init__(self, config, code=None, code_file=None):
+        super().__init__(config, code, code_file)
+        self.processes = []
+        self.commands = []
+        self.results = None
+        # Centers probed per second by each running worker.
+        self.weights = {}
+
+    def login_accounts(self, klass):
+        """
+        :returns: the config, session and :class:`Patient` list of the
+                  worker of each account, or None
+        """
+        base = {key: value for key, value in self.config.items() if key != 'accounts'}
+        workers = []
+        names = set()
+        for account in self.config['accounts']:
+            self.config = dict(base, book=True, **account)
+            if not self.login(klass) or not self.select_patients():
+                return None
+
+            for patient in self.patients:
+                name = '%(first_name)s %(last_name)s' % patient.patient
+                if name in names:
+                    log('error', text='%s is a patient of several accounts' % name)
+                    return None
+                names.add(name)
+            workers.append((self.config, self.docto.dump_state(), self.patients))
+        return workers
+
+    def find_centers(self, search):
+        key = self.engine.cache.key(self.docto.BASEURL, search.cities, search.motives)
+        centers = self.engine.cache.get(key)
+        if centers is None or self.engine.cache.is_stale(key):
+            centers = list(self.engine.fetch_centers(self.docto, key, search.cities, search.motives))
+        log('centers', count=len(centers))
+        return sorted(centers, key=search.distance)
+
+    def rebalance(self, centers):
+        indexes = sorted(self.weights)
+        shards = split(centers, [self.weights[index] for index in indexes])
+        for index, shard in zip(indexes, shards):
+            self.commands[index].put(('centers', shard))
+        log('shards', sizes=dict(zip(indexes, map(len, shards))))
+
+    def coordinate(self, workers, centers):
+        """
+        Run the workers until they are all done.
+
+        :returns: the exit code, 0 if every patient has been booked
+        """
+        context = multiprocessing.get_context('spawn')
+        self.results = context.Queue()
+        for index, ((config, state, _), shard) in enumerate(zip(workers, split(centers, [1] * len(workers)))):
+            others = [Patient(patient.patient, start_date=patient.start_date, end_date=patient.end_date,
+                              owner=owner)
+                      for owner, (_, _, owned) in enumerate(workers) if owner != index for patient in owned]
+            self.commands.append(context.Queue())
+            process = context.Process(target=work, args=(index, config, state, others, shard,
+                                                         self.commands[index], self.results),
+                                      name='doctoshotgun-worker-%d' % index, daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.weights[index] = 1
+
+        failed = False
+        swept = set()
+        while self.weights:
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                for index in list(self.weights):
+                    if not self.processes[index].is_alive():
+                        log('error', text='Worker %d died' % index)
+                        failed = True
+                        del self.weights[index]
+                continue
+
+            kind, index = message[0], message[1]
+            if kind == 'session':
+                self.sessions.put(message[1], message[2])
+                continue
+            if index not in self.weights:
+                continue
+
+            if kind == 'hit':
+                owner, center = message[2], message[3]
+                if owner in self.weights:
+                    self.commands[owner].put(('probe', center))
+                continue
+            if kind == 'booked':
+                for other in self.weights:
+                    if other != index:
+                        self.commands[other].put(('booked', message[2]))
+                continue
+
+            if kind == 'sweep':
+                count, duration = message[2], message[3]
+                if count and duration:
+                    self.weights[index] = count / duration
+                swept.add(index)
+                if swept < set(self.weights):
+                    continue
+            elif kind == 'throttled':
+                self.weights[index] /= 2
+            elif kind == 'done':
+                failed = failed or message[2] != 0
+                del self.weights[index]
+                if not self.weights:
+                    break
+
+            swept = set()
+            self.rebalance(centers)
+        return 1 if failed else 0
+
+    def run(self):
+        klass, country_code = COUNTRIES[self.config.get('country', 'France')]
+        try:
+            workers = self.login_accounts(klass)
+            if workers is None:
+                return 1
+
+            search = self.new_search(country_code)
+            if search is None:
+                return 1
+            return self.coordinate(workers, self.find_centers(search))
+        finally:
+            for commands in self.commands:
+                commands.put(('stop',))
+            for process in self.processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+            # Sessions sent by the workers while they stopped.
+            while self.results is not None:
+                try:
+                    message = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                if message[0] == 'session':
+                    self.sessions.put(message[1], message[2])
+            self.engine.shutdown()
+            self.sessions.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search vaccine slots with several Doctolib accounts at once')
+    parser.add_argument('config', help='JSON config file')
+    parser.add_argument('--code', help='auth code received from Doctolib')
+    parser.add_argument('--code-file', help='file to read auth codes from, once it exists')
+    args = parser.parse_args()
+
+    with open(args.config) as fp:
+        config = json.load(fp)
+
+    return Coordinator(config, args.code, args.code_file).run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
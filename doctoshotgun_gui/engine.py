@@ -0,0 +1,1009 @@
+"""
+Background search engine.
+
+Every call made on the Doctolib browser is blocking, so they all run in
+worker threads. The search loop streams its progress as events, which the
+caller drains from a queue on its own loop.
+"""
+import cProfile
+import logging
+import pstats
+import queue
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+from woob.browser.exceptions import HTTPError
+from woob.exceptions import BrowserInteraction
+
+from doctoshotgun_gui.cache import Center, CenterCache
+from doctoshotgun_gui.geo import distance
+from doctoshotgun_gui.metrics import METRICS
+from doctoshotgun_gui.pool import ConnectionPool
+from doctoshotgun_gui.scheduler import Scheduler, is_throttling
+from doctoshotgun_gui.slots import SlotIndex
+from doctoshotgun_gui.stats import CenterStats
+
+
+# Motives of second and third doses, fetched with the matching flag of
+# find_appointments().
+SECOND_DOSES = ('KEY_PFIZER_SECOND', 'KEY_MODERNA_SECOND', 'KEY_ASTRAZENECA_SECOND')
+THIRD_DOSES = ('KEY_PFIZER_THIRD', 'KEY_MODERNA_THIRD')
+
+
+class Event:
+    text: str
+
+    def __init__(self, text=''):
+        self.text = text
+
+
+class NewEvent(Event):
+    """
+    A new line of progress.
+    """
+
+
+class UpdateEvent(Event):
+    """
+    Text appended to the current line of progress.
+    """
+
+
+class FoundEvent(Event):
+    """
+    An appointment has been found. The search is over.
+    """
+
+    def __init__(self, appointment, seen=None, center=None, patient=None, text='found!'):
+        super().__init__(text)
+        self.appointment = appointment
+        # time.monotonic() when the probe returned the appointment
+        self.seen = seen
+        # search result of the center, with its position
+        self.center = center
+        # the patient the appointment fits
+        self.patient = patient
+
+
+class BookedEvent(Event):
+    """
+    An appointment has been found and booked automatically. The search is
+    over if it was the last patient to book for.
+    """
+
+    def __init__(self, appointment, latency, center=None, patient=None):
+        super().__init__('booked in %.1fs!' % latency)
+        self.appointment = appointment
+        # seconds between the probe returning the slot and its booking
+        self.latency = latency
+        self.center = center
+        self.patient = patient
+
+
+class ErrorEvent(Event):
+    """
+    The search has been interrupted by an exception.
+    """
+
+    def __init__(self, exception):
+        super().__init__(str(exception))
+        self.exception = exception
+
+
+class ThrottledEvent(NewEvent):
+    """
+    Doctolib throttled a request, and the search slowed down.
+    """
+
+    def __init__(self, rate):
+        super().__init__('Throttled by Doctolib, slowing down to %.1f req/s' % rate)
+        # requests per second now allowed
+        self.rate = rate
+
+
+class SweepEvent(NewEvent):
+    """
+    Every known center has been probed once.
+    """
+
+    def __init__(self, centers, duration):
+        super().__init__('Sweep of %d centers in %.1fs' % (centers, duration))
+        self.centers = centers
+        self.duration = duration
+
+
+class StoppedEvent(Event):
+    """
+    The search has been cancelled.
+    """
+
+
+def session_expiry(browser):
+    """
+    Timestamp when the first Doctolib cookie of the session expires, or
+    None if they all last until the browser is closed.
+    """
+    expiry = [cookie.expires for cookie in browser.session.cookies
+              if cookie.expires and 'doctolib' in cookie.domain
+              # Cloudflare cookies are renewed by any request.
+              and not cookie.name.startswith(('__cf', 'cf_'))]
+    return min(expiry) if expiry else None
+
+
+def run_inline(func, *args):
+    """
+    Same as ``executor.submit()``, but in the calling thread.
+    """
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def default_field_value(field):
+    """
+    Answer to a custom field of the booking form which doesn't need to be
+    asked to the user, or None.
+    """
+    if field['id'] == 'cov19':
+        return 'Non'
+    if field['placeholder']:
+        return field['placeholder']
+    return None
+
+
+def fill_custom_fields(fields, answers=None):
+    """
+    Answer every custom field of the booking form, from the saved answers
+    of the patient or the default ones.
+
+    :returns: the answers, or None if some field has to be asked to the user
+    """
+    answers = answers or {}
+    values = {}
+    for field in fields:
+        value = answers.get(field['id'], default_field_value(field))
+        if value is None:
+            return None
+        values[field['id']] = value
+    return values
+
+
+class Patient:
+    """
+    A patient to find a slot for.
+
+    :param patient: the patient, as returned by the browser
+    :param answers: saved answers of the patient to the booking form
+    :param start_date: first date acceptable for this patient, if later
+                       than the search's
+    :param end_date: last date acceptable for this patient, if earlier
+                     than the search's
+    :param owner: who books for this patient, if it is not a patient of
+                  the browser's account; slots found for it end the
+                  search without being booked
+    """
+
+    def __init__(self, patient, answers=None, start_date=None, end_date=None, owner=None):
+        self.patient = patient
+        self.answers = answers
+        self.start_date = start_date
+        self.end_date = end_date
+        self.owner = owner
+
+    def accepts(self, appointment):
+        day = appointment.slots[0].date()
+        return (self.start_date is None or day >= self.start_date) and \
+               (self.end_date is None or day <= self.end_date)
+
+
+class Search:
+    """
+    Parameters and state of one search.
+
+    Several patients can be searched for at once: each appointment found by
+    the sweep goes to the first patient it fits, and the search goes on
+    until every patient has one.
+
+    :param cities: Doctolib names of the cities to search in
+    :param motives: keys of the vaccine motives
+    :param origin: (lat, lon) to probe centers nearest first, if known
+    :param auto_book: book the first slot found, as soon as it is found
+    :param patients: :class:`Patient` list, the patient of the browser
+                     alone if None
+    :param centers: search results of the centers to probe, instead of all
+                    the centers of the cities; can be replaced while the
+                    search runs, and is read again by the next sweep
+    """
+
+    def __init__(self, cities, motives, start_date, end_date, origin=None, auto_book=False, patients=None,
+                 centers=None):
+        self.cities = cities
+        self.motives = motives
+        self.start_date = start_date
+        self.end_date = end_date
+        self.origin = origin
+        self.auto_book = auto_book
+        # Patients without an appointment yet.
+        self.patients = patients
+        self.centers = centers
+        # Centers to probe before the others, added while the search runs.
+        self.priority = []
+
+        self.emit = None
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.probes = 0
+        # Number of skipped slots found in each center by its last probe,
+        # to only report changes.
+        self.results = {}
+        # Number of probes and their total duration, by center URL.
+        self.timings = {}
+        # Centers already probed by the interrupted sweep of a previous
+        # run, skipped by the first sweep.
+        self.resumed = set()
+        # Identifies the search in the journal.
+        self.key = None
+
+    def match(self, appointment):
+        """
+        :returns: the first patient without an appointment this one fits,
+                  or None
+        """
+        for patient in self.patients:
+            if patient.accepts(appointment):
+                return patient
+        return None
+
+    def distance(self, center):
+        """
+        Distance of a center from the origin of the search, in km.
+        """
+        position = center.get('position') or {}
+        if self.origin is None or position.get('lat') is None:
+            return float('inf')
+        return distance(self.origin[0], self.origin[1], position['lat'], position['lng'])
+
+
+class SearchEngine:
+    """
+    Runs Doctolib calls in worker threads.
+
+    The browser is not thread safe, so every call on it goes through a
+    single worker: :meth:`submit` for one-shot calls (login, patients,
+    booking…), :meth:`start` for the search loop.
+
+    Availability of centers is probed by up to :attr:`concurrency` threads
+    at once, each one with its own copy of the browser. Copies share the
+    keep-alive connections of a :class:`ConnectionPool`, and their requests
+    are paced by a shared :class:`Scheduler`. A probe failing on anything
+    but throttling only skips its center; the search ends when
+    :attr:`max_failed_sweeps` sweeps fail in a row.
+
+    The list of centers is kept in a :class:`CenterCache`, so only the
+    first sweep has to page through the search results.
+
+    Timings and counters are collected in :attr:`metrics`.
+
+    The session is logged in again when it is about to expire, and saved in
+    :attr:`sessions` if given.
+
+    Appointments found are recorded in a :class:`SlotIndex`, and the ones
+    rejected by the user or which couldn't be booked are skipped.
+
+    Events and probes are written in the :class:`Journal` if given, and a
+    search interrupted in the middle of a sweep resumes from there.
+
+    Probes are counted in :class:`CenterStats`, which decides which
+    centers each sweep probes, and in which order.
+
+    Availabilities of a center are fetched by one query for each kind of
+    dose searched (first, second, or third doses) over the whole range of
+    the search. Each query reopens the center and booking pages, so it is
+    only split further, in queries run at once, when :attr:`window` or
+    :attr:`motive_group` are set; the earliest slot found is then kept.
+
+    In long-run mode, what builds up over hours of search is dropped every
+    :attr:`trim_period` sweeps, see :meth:`trim`.
+    """
+
+    concurrency = 4
+    # Seconds before the session expires to log in again.
+    session_margin = 600
+    # Days of availabilities fetched by one query, None for the whole
+    # range of the search.
+    window = None
+    # Motives fetched by one query, None for all those of a kind of dose.
+    motive_group = None
+    # Sweeps between two trims in long-run mode.
+    trim_period = 10
+    # Sweeps failing in a row, on an error of every probe or before
+    # probing, which end the search.
+    max_failed_sweeps = 3
+    # Seconds to wait before the sweep following a failed one.
+    retry_delay = 10
+    # Minimum seconds between the starts of two sweeps: the scheduler only
+    # paces requests, and a sweep may send none.
+    min_sweep_seconds = 1
+
+    def __init__(self, concurrency=None, scheduler=None, cache=None, transports=(), metrics=None,
+                 sessions=None, slots=None, journal=None, stats=None, pool=None, alerts=None,
+                 long_run=False):
+        """
+        :param transports: objects whose ``install(browser)`` is called on
+                           every browser, after the engine's own (e.g. a
+                           :class:`replay.Recorder`)
+        :type sessions: :class:`sessions.SessionStore`
+        :type slots: :class:`SlotIndex`
+        :type journal: :class:`journal.Journal`
+        :type stats: :class:`CenterStats`
+        :type pool: :class:`ConnectionPool`
+        :type alerts: :class:`alerts.Alerts`
+        :param long_run: trim the state of the engine between sweeps
+        """
+        if concurrency is not None:
+            self.concurrency = concurrency
+
+        self.scheduler = scheduler or Scheduler()
+        self.metrics = metrics or METRICS
+        # Probes, queries, the worker and the refresh of centers.
+        self.pool = pool or ConnectionPool(self.concurrency * 2 + 2, metrics=self.metrics)
+        # The pool replaces the adapters of the session, then metrics are
+        # installed, so request timings don't include the time spent
+        # waiting for the scheduler.
+        self.transports = [self.pool, self.metrics, self.scheduler] + list(transports)
+        self.profile_path = None
+        self.cache = cache or CenterCache()
+        self.refreshing = set()
+        self.sessions = sessions
+        self.slots = slots or SlotIndex()
+        self.journal = journal
+        self.stats = stats or CenterStats()
+        self.alerts = alerts
+        self.long_run = long_run
+        # Bumped when the session of the main browser is renewed, so that
+        # copies reload it.
+        self.generation = 0
+        self.refused_expiry = None
+        # Browsers created before login, by class.
+        self.prepared = {}
+        self.docto = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='doctoshotgun')
+        self.probers = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='doctoshotgun-probe')
+        # Separate from probers, which wait for them.
+        self.fetchers = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='doctoshotgun-fetch')
+        self.cancelled = threading.Event()
+
+    @property
+    def docto(self):
+        return self._docto
+
+    @docto.setter
+    def docto(self, docto):
+        # Copies of the previous browser belong to another session.
+        self._docto = docto
+        self.browsers = queue.LifoQueue()
+        if docto is not None:
+            self.setup_browser(docto)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run a blocking call in the worker thread.
+
+        :rtype: concurrent.futures.Future
+        """
+        return self.executor.submit(func, *args, **kwargs)
+
+    def start(self, emit, search):
+        """
+        Cancel any running search and start a new one.
+
+        :param emit: called from worker threads with each :class:`Event`
+        :type search: :class:`Search`
+        :rtype: concurrent.futures.Future
+        """
+        self.cancel()
+        if search.patients is None:
+            search.patients = [Patient(self.docto.patient)]
+        search.key = self.cache.key(self.docto.BASEURL, search.cities, search.motives)
+        if self.journal is not None:
+            emit = self.journal.wrap(search.key, emit)
+        search.emit = emit
+        self.cancelled = self.scheduler.cancelled = search.cancelled
+        return self.submit(self.search, search)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def shutdown(self):
+        self.cancel()
+        self.probers.shutdown(wait=False, cancel_futures=True)
+        self.fetchers.shutdown(wait=False, cancel_futures=True)
+        self.executor.shutdown(wait=False)
+        if self.alerts is not None:
+            self.alerts.shutdown()
+        if self.journal is not None:
+            self.journal.close()
+
+    def profile_next_sweep(self, path):
+        """
+        Run the next sweep under cProfile, and save its stats in `path`.
+
+        To show where the time of probes goes, the probes of this sweep run
+        one at a time in the search thread.
+        """
+        self.profile_path = path
+
+    def prepare_browser(self, klass):
+        """
+        Create a browser and open the login page of its site, so the
+        connection is already established when the user logs in.
+        """
+        if klass in self.prepared:
+            return
+
+        browser = klass(None, None)
+        # The connection is opened in the shared pool, where copies of
+        # the browser will find it.
+        self.pool.install(browser)
+        try:
+            browser.open(browser.BASEURL + '/sessions/new')
+        except Exception:
+            # The login will try again.
+            logging.getLogger(__name__).warning('Unable to open the login page of %s', browser.BASEURL)
+        self.prepared[klass] = browser
+
+    def new_browser(self, klass, username, password):
+        """
+        Browser for this account, the prepared one if any.
+        """
+        browser = self.prepared.pop(klass, None)
+        if browser is None:
+            return klass(username, password)
+
+        browser.username = username
+        browser.password = password
+        return browser
+
+    def setup_browser(self, browser):
+        for transport in self.transports:
+            transport.install(browser)
+
+    def acquire_browser(self):
+        """
+        Get a copy of the browser sharing the same session, dedicated to
+        the calling thread until it is given back with
+        :meth:`release_browser`.
+        """
+        try:
+            browser = self.browsers.get_nowait()
+        except queue.Empty:
+            browser = type(self.docto)(self.docto.username, self.docto.password)
+            browser.generation = None
+            self.setup_browser(browser)
+
+        if browser.generation != self.generation:
+            browser.load_state(self.docto.dump_state())
+            browser.generation = self.generation
+        browser.patient = self.docto.patient
+        return browser
+
+    def release_browser(self, browser):
+        self.browsers.put(browser)
+
+    def search(self, search):
+        try:
+            event = self.search_loop(search)
+        except Exception as e:
+            search.emit(ErrorEvent(e))
+            raise
+
+        if event is None:
+            search.emit(StoppedEvent())
+            return None
+
+        search.emit(event)
+        return event.appointment
+
+    def search_loop(self, search):
+        """
+        :returns: the :class:`FoundEvent` or :class:`BookedEvent` ending
+                  the search, None if it has been cancelled
+        """
+        queries = self.queries(search)
+        if self.journal is not None:
+            self.resume(search)
+
+        sweeps = 0
+        failed = 0
+        while not search.cancelled.is_set():
+            self.keep_session_alive(search)
+
+            profile_path, self.profile_path = self.profile_path, None
+            profiler = cProfile.Profile() if profile_path else None
+
+            started = time.monotonic()
+            try:
+                if profiler:
+                    profiler.enable()
+                centers = self.iter_centers(search)
+                if search.resumed:
+                    resumed, search.resumed = search.resumed, set()
+                    centers = (center for center in centers if center['url'] not in resumed)
+                found, count = self.sweep(search, centers, queries, inline=profiler is not None)
+            except Exception as e:
+                if search.cancelled.is_set():
+                    # Requests held back have been aborted.
+                    break
+                if is_throttling(e):
+                    self.report_throttling(search, self.docto, e)
+                    continue
+                failed += 1
+                if failed >= self.max_failed_sweeps:
+                    raise
+                # Most likely the network or Doctolib, for a while.
+                logging.getLogger(__name__).warning('Sweep failed: %s', e)
+                search.emit(NewEvent('Sweep failed (%s), trying again in %ds' % (e, self.retry_delay)))
+                search.cancelled.wait(self.retry_delay)
+                continue
+            finally:
+                if profiler:
+                    profiler.disable()
+                    pstats.Stats(profiler).dump_stats(profile_path)
+            failed = 0
+
+            if found is not None:
+                event = self.found(search, *found)
+                if isinstance(event, BookedEvent) and search.patients:
+                    # Go on for the other patients.
+                    search.emit(event)
+                elif event is not None:
+                    return event
+                continue
+            if search.cancelled.is_set():
+                break
+
+            duration = time.monotonic() - started
+            self.metrics.observe('sweep_seconds', duration)
+            search.emit(SweepEvent(count, duration))
+            self.stats.save()
+            sweeps += 1
+            if self.long_run and sweeps % self.trim_period == 0:
+                self.trim(search)
+            search.cancelled.wait(self.min_sweep_seconds - (time.monotonic() - started))
+
+        return None
+
+    def queries(self, search):
+        """
+        Availability queries of each probe, earliest dates first.
+
+        :returns: (vaccine list, start date, end date, only second doses,
+                  only third doses) tuples
+        """
+        windows = []
+        start_date = search.start_date
+        while start_date <= search.end_date:
+            end_date = search.end_date
+            if self.window is not None:
+                end_date = min(start_date + timedelta(days=self.window - 1), end_date)
+            windows.append((start_date, end_date))
+            start_date = end_date + timedelta(days=1)
+
+        second = [getattr(self.docto, name, None) for name in SECOND_DOSES]
+        third = [getattr(self.docto, name, None) for name in THIRD_DOSES]
+        if self.motive_group:
+            groups = [search.motives[i:i + self.motive_group]
+                      for i in range(0, len(search.motives), self.motive_group)]
+        else:
+            # Second and third doses are only listed by queries of their own.
+            groups = [[motive for motive in search.motives if motive not in second and motive not in third],
+                      [motive for motive in search.motives if motive in second],
+                      [motive for motive in search.motives if motive in third]]
+            groups = [group for group in groups if group]
+        return [([self.docto.vaccine_motives[motive] for motive in group], start_date, end_date,
+                 all(motive in second for motive in group), all(motive in third for motive in group))
+                for start_date, end_date in windows for group in groups]
+
+    def trim(self, search):
+        """
+        Drop what builds up over a long search: copies of the browser beyond
+        the size of the pool, the last page and expired cookies of the
+        others, slots past their date, and results of centers no longer
+        searched.
+        """
+        browsers = []
+        while True:
+            try:
+                browsers.append(self.browsers.get_nowait())
+            except queue.Empty:
+                break
+
+        # Most recently used first.
+        for browser in reversed(browsers[:self.pool.size]):
+            browser.page = None
+            browser.response = None
+            browser.session.cookies.clear_expired_cookies()
+            self.release_browser(browser)
+
+        self.slots.prune()
+
+        if search.centers is not None:
+            urls = set(center['url'] for center in search.centers)
+        else:
+            urls = set(center['url'] for center in self.cache.get(search.key) or ())
+        if urls:
+            with search.lock:
+                search.results = {url: value for url, value in search.results.items() if url in urls}
+                search.timings = {url: value for url, value in search.timings.items() if url in urls}
+
+    def keep_session_alive(self, search):
+        """
+        Log in again before the session expires, so the search doesn't
+        stop on a login page.
+        """
+        expiry = session_expiry(self.docto)
+        if expiry is None or expiry - time.time() > self.session_margin or expiry == self.refused_expiry:
+            return
+
+        search.emit(NewEvent('Renewing Doctolib session... '))
+        try:
+            logged = self.docto.do_login()
+        except BrowserInteraction:
+            # Doctolib asks for an auth code, only the user can give it.
+            logged = False
+        if not logged:
+            self.refused_expiry = expiry
+            search.emit(UpdateEvent('unable to log in again, please restart the search after it expires'))
+            return
+
+        self.generation += 1
+        if self.sessions is not None:
+            self.sessions.save(self.docto)
+        search.emit(UpdateEvent('done'))
+
+    def resume(self, search):
+        """
+        Restore the timings of centers and the cursor of the last sweep from
+        the journal.
+        """
+        search.resumed, timings = self.journal.resume(search.key)
+        search.timings.update(timings)
+        self.journal.write('start', search=search.key, cities=search.cities, motives=search.motives,
+                           start_date=search.start_date, end_date=search.end_date)
+        if search.resumed:
+            search.emit(NewEvent('Resuming the last sweep, %d centers already probed' % len(search.resumed)))
+
+    def found(self, search, center, appointment, browser, seen):
+        """
+        Book the appointment right away in auto-book mode, with the browser
+        which found it, unless it is for a patient of another account.
+
+        :returns: the event ending the search, a :class:`BookedEvent` if
+                  there are other patients to search for, or None to
+                  search again
+        """
+        patient = search.match(appointment)
+        if not search.auto_book:
+            # Before anything else, the user has to book it in time.
+            self.alert('found', center, appointment, patient, seen)
+        state = SlotIndex.SEEN
+        try:
+            if search.auto_book and patient.owner is None:
+                custom_fields = fill_custom_fields(appointment.custom_fields, patient.answers)
+                if custom_fields is not None:
+                    browser.patient = patient.patient
+                    if browser.book_appointment(appointment, custom_fields):
+                        latency = time.monotonic() - seen
+                        self.metrics.observe('found_to_booked_seconds', latency, mode='auto')
+                        self.alert('booked', center, appointment, patient, seen)
+                        search.patients.remove(patient)
+                        return BookedEvent(appointment, latency, center, patient.patient)
+
+                    state = SlotIndex.FAILED
+                    search.emit(UpdateEvent('unable to book, searching again'))
+                    return None
+
+                # The user has to fill the booking form.
+                self.alert('found', center, appointment, patient, seen)
+            return FoundEvent(appointment, seen, center, patient.patient)
+        finally:
+            # The appointment has been found in the browser copy's
+            # session, keep the main one in sync.
+            self.docto.load_state(browser.dump_state())
+            if self.sessions is not None:
+                self.sessions.save(self.docto)
+            self.release_browser(browser)
+            # Written to disk once booked, not to delay it.
+            self.slots.mark(center, appointment, state)
+
+    def alert(self, kind, center, appointment, patient, seen):
+        if self.alerts is not None:
+            self.alerts.alert(kind, appointment, center, patient.patient, seen)
+
+    def iter_centers(self, search):
+        """
+        Centers of the search to probe in this sweep, most likely first, then
+        nearest first, when they come from the cache or the search. Otherwise
+        they are all yielded as they are found, city after city.
+        """
+        if search.centers is not None:
+            return iter(self.stats.schedule(sorted(search.centers, key=search.distance)))
+
+        key = self.cache.key(self.docto.BASEURL, search.cities, search.motives)
+        centers = self.cache.get(key)
+        if centers is None:
+            return self.fetch_centers(self.docto, key, search.cities, search.motives)
+
+        if self.cache.is_stale(key):
+            self.refresh_centers(key, search.cities, search.motives)
+        return iter(self.stats.schedule(sorted(centers, key=search.distance)))
+
+    def fetch_centers(self, browser, key, cities, motives):
+        """
+        Yield centers as they are found, and cache them once the whole
+        list has been read.
+
+        Only the time spent by the browser is measured, not the one spent
+        by the caller between two centers: for the whole list, and for each
+        page of search results with the centers read from it.
+
+        The browser stops listing without an error when Doctolib or
+        Cloudflare answers with a server error, so a list which saw one is
+        cached as stale, to be fetched again.
+        """
+        centers = []
+        errors = []
+
+        def listen(response, *args, **kwargs):
+            if response.status_code >= 500:
+                errors.append(response.status_code)
+
+        found = iter(browser.find_centers(cities, motives))
+        total = page_seconds = 0
+        page = None
+        while True:
+            started = time.monotonic()
+            browser.session.hooks['response'].append(listen)
+            try:
+                center = next(found, None)
+            finally:
+                browser.session.hooks['response'].remove(listen)
+            elapsed = time.monotonic() - started
+            total += elapsed
+            if center is None:
+                break
+
+            # Search pages are loaded with go(), center results opened
+            # without replacing the page.
+            if browser.page is not page:
+                if page is not None:
+                    self.metrics.observe('phase_seconds', page_seconds, phase='find_centers_page')
+                page, page_seconds = browser.page, 0
+            page_seconds += elapsed
+
+            center = Center(center)
+            centers.append(center)
+            yield center
+
+        if page is not None:
+            self.metrics.observe('phase_seconds', page_seconds + elapsed, phase='find_centers_page')
+        self.metrics.observe('phase_seconds', total, phase='find_centers')
+        self.cache.put(key, centers, complete=not errors)
+
+    def refresh_centers(self, key, cities, motives):
+        if key in self.refreshing:
+            return
+
+        self.refreshing.add(key)
+        threading.Thread(target=self.refresh_centers_thread, args=(key, cities, motives),
+                         name='doctoshotgun-refresh', daemon=True).start()
+
+    def refresh_centers_thread(self, key, cities, motives):
+        browser = self.acquire_browser()
+        try:
+            for center in self.fetch_centers(browser, key, cities, motives):
+                pass
+        except Exception:
+            # The stale list is still used, it will be retried next sweep.
+            logging.getLogger(__name__).exception('Unable to refresh centers')
+        finally:
+            self.release_browser(browser)
+            self.refreshing.discard(key)
+
+    def report_throttling(self, search, browser, exception):
+        host = urlparse(browser.BASEURL).netloc
+        if not isinstance(exception, HTTPError):
+            # Blocks detected from the page content have not been seen
+            # by the scheduler's adapter.
+            self.scheduler.throttled(host)
+        search.emit(ThrottledEvent(self.scheduler.get_rate(host)))
+
+    def sweep(self, search, centers, queries, inline=False):
+        """
+        Probe centers concurrently, and stop at the first appointment found.
+        A center whose probe fails is skipped until the next sweep.
+
+        :param inline: run probes one at a time in the calling thread
+        :returns: the center, its appointment, the browser which found it
+                  and when, or None; and the number of probed centers
+        :raises: the last error, if every probe failed
+        """
+        submit = run_inline if inline else self.probers.submit
+        stop = threading.Event()
+        centers = iter(centers)
+        pending = set()
+        count = 0
+        errors = []
+
+        try:
+            while not search.cancelled.is_set():
+                while len(pending) < self.concurrency:
+                    center = search.priority.pop(0) if search.priority else next(centers, None)
+                    if center is None:
+                        break
+                    pending.add(submit(self.probe, search, stop, center, queries, inline))
+                    count += 1
+
+                if not pending:
+                    break
+
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                hits = []
+                for future in done:
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                    elif future.result() is not None:
+                        hits.append(future.result())
+                if hits:
+                    center = hits[0][0]
+                    for hit in hits[1:]:
+                        self.release_browser(hit[2])
+                    search.emit(NewEvent('Center %(name_with_title)s (%(city)s)... ' % center))
+                    return hits[0], count
+        finally:
+            # Probes already running can't be interrupted, but they will
+            # not look further and their results are ignored.
+            stop.set()
+            for future in pending:
+                if not future.cancel():
+                    future.add_done_callback(self.release_ignored)
+
+        if errors and len(errors) == count and not search.cancelled.is_set():
+            raise errors[-1]
+        return None, count
+
+    def release_ignored(self, future):
+        if not future.exception() and future.result() is not None:
+            self.release_browser(future.result()[2])
+
+    def probe(self, search, stop, center, queries, inline=False):
+        if stop.is_set():
+            return None
+
+        with search.lock:
+            search.probes += 1
+
+        name = center['name_with_title']
+        self.metrics.inc('probes_total', center=name)
+        result = 'error'
+        started = time.monotonic()
+        try:
+            with self.metrics.center(name), self.metrics.time('find_appointments'):
+                if len(queries) == 1 or inline:
+                    found, skipped = self.fetch_each(search, stop, center, queries)
+                else:
+                    found, skipped = self.fetch_all(search, stop, center, queries)
+            if found is not None:
+                # The browser is kept to book the appointment, and
+                # released by found().
+                result = 'found'
+                return (center,) + found
+            result = 'skipped' if skipped else 'none'
+        except Exception as e:
+            if not is_throttling(e):
+                self.metrics.inc('errors_total', center=name)
+                logging.getLogger(__name__).warning('Unable to probe %s: %s', name, e)
+                search.emit(NewEvent('Center %s (%s)... error: %s' % (name, center['city'], e)))
+                raise
+            self.metrics.inc('blocks_total', center=name)
+            result = 'blocked'
+            self.report_throttling(search, self.docto, e)
+            return None
+        finally:
+            self.record_probe(search, center, result, time.monotonic() - started)
+
+        if stop.is_set() or search.results.get(center['url']) == skipped:
+            return None
+
+        search.results[center['url']] = skipped
+        if skipped:
+            search.emit(NewEvent('Center %s (%s)... %d known slots skipped' % (name, center['city'], skipped)))
+        else:
+            search.emit(NewEvent('Center %(name_with_title)s (%(city)s)... not found' % center))
+        return None
+
+    def fetch(self, search, stop, center, query):
+        """
+        Run one availability query with a copy of the browser.
+
+        :param query: one of :meth:`queries`
+        :returns: the first appointment to propose, the browser which found
+                  it and when, or None; and the number of skipped slots
+        """
+        if stop.is_set():
+            return None, 0
+
+        vaccine_list, start_date, end_date, only_second, only_third = query
+        browser = self.acquire_browser()
+        skipped = 0
+        try:
+            # Queries may run in another thread than the probe.
+            with self.metrics.center(center['name_with_title']):
+                for appointment in browser.find_appointments(center, vaccine_list, start_date, end_date,
+                                                             [], only_second, only_third):
+                    if self.slots.is_skipped(center, appointment) or search.match(appointment) is None:
+                        skipped += 1
+                        continue
+                    # Kept to book the appointment.
+                    kept, browser = browser, None
+                    return (appointment, kept, time.monotonic()), skipped
+            return None, skipped
+        finally:
+            if browser is not None:
+                self.release_browser(browser)
+
+    def fetch_each(self, search, stop, center, queries):
+        """
+        Run availability queries one after the other, until one finds an
+        appointment.
+        """
+        skipped = 0
+        for query in queries:
+            found, count = self.fetch(search, stop, center, query)
+            skipped += count
+            if found is not None:
+                return found, skipped
+        return None, skipped
+
+    def fetch_all(self, search, stop, center, queries):
+        """
+        Run availability queries concurrently. The appointment of the
+        earliest query is returned as soon as the queries before it have
+        found nothing, and the later ones are dropped.
+        """
+        futures = [self.fetchers.submit(self.fetch, search, stop, center, query) for query in queries]
+        skipped = 0
+        try:
+            while futures:
+                found, count = futures.pop(0).result()
+                skipped += count
+                if found is not None:
+                    return found, skipped
+            return None, skipped
+        finally:
+            for future in futures:
+                if not future.cancel():
+                    future.add_done_callback(self.release_fetched)
+
+    def release_fetched(self, future):
+        if not future.exception() and future.result()[0] is not None:
+            self.release_browser(future.result()[0][1])
+
+    def record_probe(self, search, center, result, duration):
+        with search.lock:
+            count, total = search.timings.get(center['url'], (0, 0))
+            search.timings[center['url']] = (count + 1, total + duration)
+        if result in ('none', 'skipped', 'found'):
+            # Skipped slots were turned down or fit no patient, finding
+            # them again is no reason to probe the center more often.
+            self.stats.record(center['url'], result == 'found')
+
+        if self.journal is not None:
+            self.journal.write('probe', search=search.key, center=center['url'], name=center['name_with_title'],
+                               result=result, seconds=round(duration, 3))
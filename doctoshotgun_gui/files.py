@@ -0,0 +1,37 @@
+"""
+Files of the data directory.
+
+They are replaced with an atomic rename, so a crash while saving never
+leaves a truncated file, and JSON files missing or damaged read as empty.
+"""
+import json
+import os
+
+
+def read_json(path):
+    """
+    :returns: the content of the file, an empty dict if the file is missing
+              or damaged, or if `path` is None
+    """
+    if path is None:
+        return {}
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_atomic(path, data):
+    """
+    Replace the content of a file, creating its directory if needed.
+
+    :param data: str, or bytes
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
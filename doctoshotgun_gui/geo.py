@@ -0,0 +1,189 @@
+"""
+Offline index of postal codes.
+
+Each country has a compact file in resources, built from the GeoNames
+postal code dump of the country (CC BY 4.0) before packaging the app::
+
+    python -m doctoshotgun_gui.geo FR
+    python -m doctoshotgun_gui.geo DE
+
+The dump is downloaded, unless the path of one already downloaded is given
+after the country code. Countries without a file can't be searched by ZIP
+code.
+
+The file is memory-mapped on first use: a header, fixed size records
+sorted by postal code, then the newline-separated city names.
+"""
+import io
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import unicodedata
+import urllib.request
+import zipfile
+from math import asin, cos, radians, sin, sqrt
+
+MAGIC = b'DSGEO1'
+HEADER = struct.Struct('<6sII')     # magic, records count, names offset
+RECORD = struct.Struct('<5siiI')    # postal code, lat and lon in 1e-5 degrees, name index
+
+RESOURCES = os.path.join(os.path.dirname(__file__), 'resources')
+DUMP_URL = 'https://download.geonames.org/export/zip/%s.zip'
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in km.
+    """
+    lat1, lon1, lat2, lon2 = map(radians, (lat1, lon1, lat2, lon2))
+    a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * asin(sqrt(a))
+
+
+def slugify(name):
+    """
+    Doctolib's name of a city in search URLs.
+    """
+    # Districts of Paris, Lyon and Marseille are searched with the city.
+    name = re.sub(r' \d+( .*)?$', '', name)
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return re.sub(r'\W+', '-', name).strip('-').lower()
+
+
+class GeoIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.names_offset = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a geo index' % path)
+        self._names = None
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self.data[self.names_offset:].decode('utf-8').split('\n')
+        return self._names
+
+    def record(self, i):
+        return RECORD.unpack_from(self.data, HEADER.size + i * RECORD.size)
+
+    def locate(self, zipcode):
+        """
+        :returns: (lat, lon) of this postal code, or None if it is unknown
+        """
+        key = zipcode.strip().encode('ascii', 'ignore')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self.count:
+            return None
+        code, lat, lon, _ = self.record(lo)
+        if code != key:
+            return None
+        return lat / 1e5, lon / 1e5
+
+    def cities_around(self, lat, lon, radius, limit=None):
+        """
+        Cities within `radius` km of this point, nearest first.
+        """
+        cities = {}
+        records = memoryview(self.data)[HEADER.size:HEADER.size + self.count * RECORD.size]
+        try:
+            for _, clat, clon, name in RECORD.iter_unpack(records):
+                d = distance(lat, lon, clat / 1e5, clon / 1e5)
+                if d <= radius and d < cities.get(name, radius + 1):
+                    cities[name] = d
+        finally:
+            records.release()
+
+        nearest = sorted(cities, key=cities.get)[:limit]
+        return [self.names[name] for name in nearest]
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(country):
+    """
+    :param country: ISO 3166 code of the country
+    :returns: the :class:`GeoIndex` of this country, or None if it is not
+              bundled
+    """
+    with _lock:
+        if country not in _indexes:
+            path = os.path.join(RESOURCES, 'geo_%s.bin' % country)
+            _indexes[country] = GeoIndex(path) if os.path.exists(path) else None
+        return _indexes[country]
+
+
+def find_cities(country, zipcode, radius, limit=None):
+    """
+    :returns: the position of the ZIP code and the cities around it, nearest
+              first. Cities are None if the country has no index, empty if
+              the ZIP code is unknown.
+    """
+    index = get_index(country)
+    if index is None:
+        return None, None
+
+    origin = index.locate(zipcode)
+    if origin is None:
+        return None, []
+    return origin, index.cities_around(*origin, radius, limit=limit)
+
+
+def download(country):
+    """
+    :returns: the lines of the GeoNames postal code dump of a country
+    """
+    with urllib.request.urlopen(DUMP_URL % country) as response:
+        archive = zipfile.ZipFile(io.BytesIO(response.read()))
+    return archive.read('%s.txt' % country).decode('utf-8').splitlines()
+
+
+def build(country, src=None):
+    """
+    Build the index of a country from a GeoNames postal code dump
+    (https://download.geonames.org/export/zip/).
+
+    :param src: path of the dump, downloaded if None
+    """
+    if src is None:
+        lines = download(country)
+    else:
+        with open(src, encoding='utf-8') as fp:
+            lines = fp.read().splitlines()
+
+    names = {}
+    records = {}
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        code, name, lat, lon = fields[1], fields[2], fields[9], fields[10]
+        slug = slugify(name)
+        if len(code) != 5 or not lat or not lon or (code, slug) in records:
+            continue
+        index = names.setdefault(slug, len(names))
+        records[code, slug] = RECORD.pack(code.encode('ascii'), round(float(lat) * 1e5), round(float(lon) * 1e5), index)
+
+    body = b''.join(records[key] for key in sorted(records))
+    path = os.path.join(RESOURCES, 'geo_%s.bin' % country)
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, len(records), HEADER.size + len(body)))
+        fp.write(body)
+        fp.write('\n'.join(names).encode('utf-8'))
+
+
+if __name__ == '__main__':
+    build(*sys.argv[1:3])
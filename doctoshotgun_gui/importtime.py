@@ -0,0 +1,72 @@
+"""
+Import-time budget.
+
+Imports a module in a new interpreter and checks that it stays under a time
+budget, and that it doesn't load the scraping stack, which the GUI imports
+from a thread once its first screen is shown::
+
+    python -m doctoshotgun_gui.importtime --budget 0.5 doctoshotgun_gui.app
+
+Exits with an error when the budget is exceeded.
+"""
+import argparse
+import subprocess
+import sys
+
+# Top-level packages which must not be imported by the module.
+DEFERRED = ('woob', 'doctoshotgun', 'dateutil', 'requests', 'urllib3', 'cloudscraper')
+
+
+def measure(module):
+    """
+    :returns: the import time of every module loaded by `module`, in
+              seconds, in import order, and the one of `module`
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        # "import time: <self us> | <cumulative us> | <indented name>"
+        _, cumulative, name = line.split('|')
+        duration = int(cumulative) / 1e6
+        if name.startswith('  '):
+            imports.append((name.strip(), duration))
+        elif name.strip() == module:
+            return imports, duration
+        else:
+            # Imported by the interpreter itself (site…), before the module.
+            imports = []
+    return imports, 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of a module')
+    parser.add_argument('module', nargs='?', default='doctoshotgun_gui.app')
+    parser.add_argument('--budget', type=float, default=0.5, help='maximum import time, in seconds')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    imports, total = measure(args.module)
+    for name, duration in sorted(imports, key=lambda item: item[1], reverse=True)[:args.top]:
+        print('%8.1fms  %s' % (duration * 1000, name))
+    print('Total: %.1fms (budget: %.1fms)' % (total * 1000, args.budget * 1000))
+
+    failed = False
+    deferred = sorted(set(name.split('.')[0] for name, _ in imports) & set(DEFERRED))
+    if deferred:
+        print('Imported too early: %s' % ', '.join(deferred), file=sys.stderr)
+        failed = True
+    if total > args.budget:
+        print('Over budget', file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,206 @@
+"""
+Journal of searches.
+
+Every event of a search, and every probe of a center with its result and
+duration, is appended to a JSON lines file. Each line is flushed as soon as
+it is written, so the journal survives a crash of the app.
+
+The journal is moved to journal.jsonl.1 when it grows over
+:attr:`Journal.MAX_SIZE`. What a search needs to start again is kept
+apart, in the small journal.state.json, so it is not read back from the
+journal: centers probed by an interrupted sweep are not probed again first,
+and timings of centers are restored. The journal can be summarized
+offline::
+
+    python -m doctoshotgun_gui.journal ~/.local/share/doctoshotgun_gui/journal.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from doctoshotgun_gui.files import read_json, write_atomic
+
+
+class Journal:
+    FILENAME = 'journal.jsonl'
+    # Size above which the journal is moved to journal.jsonl.1.
+    MAX_SIZE = 50 * 1024 * 1024
+    # Searches whose state is kept, the most recent ones.
+    MAX_SEARCHES = 100
+    # Seconds before a change of the state is written.
+    DELAY = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.state_path = '%s.state.json' % os.path.splitext(path)[0]
+        self.lock = threading.Lock()
+        self.fp = None
+        self.size = 0
+        # Search key -> centers probed by the current sweep, and number of
+        # probes and total duration of each center.
+        self.state = None
+        self.timer = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fp = open(self.path, 'a')
+        self.size = self.fp.tell()
+
+    def rotate(self):
+        self.fp.close()
+        os.replace(self.path, '%s.1' % self.path)
+        self.open()
+
+    def write(self, kind, **fields):
+        line = json.dumps(dict(fields, time=time.time(), kind=kind), default=str)
+        with self.lock:
+            if self.fp is None:
+                self.open()
+            self.fp.write(line + '\n')
+            self.fp.flush()
+            # ASCII, as escaped by json.dumps().
+            self.size += len(line) + 1
+            if self.size > self.MAX_SIZE:
+                self.rotate()
+            self.update(kind, fields)
+
+    def ensure_loaded(self):
+        if self.state is None:
+            self.state = {key: {'probed': set(state['probed']), 'timings': state['timings']}
+                          for key, state in read_json(self.state_path).items()}
+
+    def update(self, kind, fields):
+        """
+        Update the state of the search from a record of the journal.
+        """
+        key = fields.get('search')
+        if key is None or kind not in ('probe', 'SweepEvent', 'BookedEvent'):
+            return
+
+        self.ensure_loaded()
+        # Moved to the end, as the most recent search.
+        state = self.state.pop(key, None) or {'probed': set(), 'timings': {}}
+        self.state[key] = state
+        for old in list(self.state)[:max(0, len(self.state) - self.MAX_SEARCHES)]:
+            del self.state[old]
+
+        if kind == 'probe':
+            # Centers with a slot or an error are probed again.
+            if fields['result'] in ('none', 'skipped'):
+                state['probed'].add(fields['center'])
+            count, total = state['timings'].get(fields['center'], (0, 0))
+            state['timings'][fields['center']] = (count + 1, total + fields['seconds'])
+        else:
+            state['probed'] = set()
+
+        if self.timer is None:
+            self.timer = threading.Timer(self.DELAY, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if self.state is None:
+                return
+            data = json.dumps(self.state, default=list)
+        write_atomic(self.state_path, data)
+
+    def event(self, key, event):
+        fields = {'search': key, 'text': event.text}
+        center = getattr(event, 'center', None)
+        if center:
+            fields['center'] = center['url']
+        appointment = getattr(event, 'appointment', None)
+        if appointment is not None:
+            fields['slots'] = [slot.isoformat() for slot in appointment.slots]
+        for attr in ('latency', 'duration', 'centers'):
+            if hasattr(event, attr):
+                fields[attr] = getattr(event, attr)
+        self.write(type(event).__name__, **fields)
+
+    def wrap(self, key, emit):
+        """
+        :returns: `emit`, also writing events in the journal
+        """
+        def journaled(event):
+            self.event(key, event)
+            emit(event)
+        return journaled
+
+    def read(self):
+        try:
+            fp = open(self.path, 'r')
+        except IOError:
+            return
+
+        with fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Last line cut by a crash.
+                    continue
+
+    def resume(self, key):
+        """
+        State of the previous runs of a search.
+
+        :returns: URLs of the centers already probed by the last sweep, if
+                  it has been interrupted, and the number of probes and
+                  total duration of each center
+        """
+        with self.lock:
+            self.ensure_loaded()
+            state = self.state.get(key)
+            if state is None:
+                return set(), {}
+            return set(state['probed']), {url: tuple(timing) for url, timing in state['timings'].items()}
+
+    def close(self):
+        """
+        Close the journal, and write the state now.
+        """
+        with self.lock:
+            timer = self.timer
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+        if timer is not None:
+            timer.cancel()
+            self.flush()
+
+
+def summarize(journal):
+    """
+    Probes, results and mean duration of each center.
+    """
+    centers = {}
+    for record in journal.read():
+        if record['kind'] != 'probe':
+            continue
+        center = centers.setdefault(record['center'], {'name': record.get('name'), 'probes': 0,
+                                                       'seconds': 0, 'results': {}})
+        center['probes'] += 1
+        center['seconds'] += record['seconds']
+        center['results'][record['result']] = center['results'].get(record['result'], 0) + 1
+
+    for center in centers.values():
+        center['mean_seconds'] = center.pop('seconds') / center['probes']
+    return centers
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a journal of searches')
+    parser.add_argument('journal')
+    args = parser.parse_args()
+
+    print(json.dumps(summarize(Journal(args.journal)), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
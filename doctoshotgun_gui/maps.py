@@ -0,0 +1,61 @@
+"""
+Static map images of centers.
+
+The OpenStreetMap tile around a center is downloaded once and kept on disk,
+so the confirmation screen shows where the center is without loading a web
+page.
+"""
+import math
+import os
+import urllib.request
+
+from doctoshotgun_gui.files import write_atomic
+
+TILE_URL = 'https://tile.openstreetmap.org/%d/%d/%d.png'
+# Required by the tile usage policy of OpenStreetMap.
+USER_AGENT = 'doctoshotgun_gui (https://doctoshotgun.com)'
+
+
+def tile(lat, lng, zoom):
+    """
+    :returns: x and y of the tile containing this position
+    """
+    n = 2 ** zoom
+    x = int((lng + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return x, y
+
+
+class MapCache:
+    DIRNAME = 'maps'
+    ZOOM = 16
+    TIMEOUT = 10
+
+    def __init__(self, path=None):
+        """
+        :param path: directory where images are kept, None to not keep them
+        """
+        self.path = path
+
+    def get(self, center):
+        """
+        Path of the image of a center, downloaded if needed.
+
+        :param center: search result of the center
+        :returns: the path, or None if the position of the center is unknown
+        """
+        position = center.get('position') or {}
+        if self.path is None or position.get('lat') is None:
+            return None
+
+        x, y = tile(position['lat'], position['lng'], self.ZOOM)
+        path = os.path.join(self.path, '%d-%d-%d.png' % (self.ZOOM, x, y))
+        if os.path.exists(path):
+            return path
+
+        request = urllib.request.Request(TILE_URL % (self.ZOOM, x, y), headers={'User-Agent': USER_AGENT})
+        with urllib.request.urlopen(request, timeout=self.TIMEOUT) as response:
+            data = response.read()
+
+        write_atomic(path, data)
+        return path
@@ -0,0 +1,214 @@
+"""
+Latency and request metrics.
+
+:data:`METRICS` collects timings of each phase (login, patients, center
+pages, availability probes, booking…) and counters of requests, errors and
+blocks per center. They can be exported in the Prometheus text format
+from a local HTTP endpoint, or as JSON snapshots written periodically.
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from requests.adapters import BaseAdapter
+
+from doctoshotgun_gui.files import write_atomic
+
+
+class Histogram:
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in sorted(labels.items()))
+
+
+class Metrics:
+    # Instrumented methods of the Doctolib browser, and their phase name.
+    PHASES = ('do_login', 'do_otp', 'get_patients', 'book_appointment')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        # The center being probed by the current thread, to attribute
+        # requests to it.
+        self.context = threading.local()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def time(self, phase, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.inc('phase_errors_total', phase=phase, **labels)
+            raise
+        finally:
+            self.observe('phase_seconds', time.monotonic() - started, phase=phase, **labels)
+
+    @contextmanager
+    def center(self, name):
+        """
+        Attribute requests made by this thread to a center.
+        """
+        previous = getattr(self.context, 'center', None)
+        self.context.center = name
+        try:
+            yield
+        finally:
+            self.context.center = previous
+
+    def install(self, browser):
+        """
+        Time the phases of this browser and count its requests.
+        """
+        for phase in self.PHASES:
+            method = getattr(browser, phase, None)
+            if method is not None and not hasattr(method, 'metrics_phase'):
+                setattr(browser, phase, self.timed(phase, method))
+
+        adapters = browser.session.adapters
+        for prefix, adapter in adapters.items():
+            if not isinstance(adapter, MetricsAdapter):
+                adapters[prefix] = MetricsAdapter(adapter, self)
+
+    def timed(self, phase, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time(phase):
+                return func(*args, **kwargs)
+        wrapper.metrics_phase = phase
+        return wrapper
+
+    def render(self):
+        """
+        Prometheus text format.
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('doctoshotgun_%s%s %s' % (name, format_labels(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                labels = dict(labels)
+                cumulative = 0
+                for bucket, count in zip(Histogram.BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append('doctoshotgun_%s_bucket%s %s' % (name, format_labels(labels, le=bucket), cumulative))
+                lines.append('doctoshotgun_%s_sum%s %s' % (name, format_labels(labels), histogram.sum))
+                lines.append('doctoshotgun_%s_count%s %s' % (name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        with self.lock:
+            return {'time': time.time(),
+                    'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                                 for (name, labels), value in self.counters.items()],
+                    'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                                    'sum': histogram.sum, 'buckets': dict(zip(map(str, Histogram.BUCKETS + ('+Inf',)),
+                                                                             histogram.counts))}
+                                   for (name, labels), histogram in self.histograms.items()],
+                   }
+
+    def serve(self, port, host='127.0.0.1'):
+        """
+        Serve :meth:`render` on http://host:port/metrics from a thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='doctoshotgun-metrics', daemon=True).start()
+        return server
+
+    def dump(self, path):
+        write_atomic(path, json.dumps(self.snapshot()))
+
+    def dump_periodically(self, path, interval=60):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+
+        threading.Thread(target=loop, name='doctoshotgun-metrics-dump', daemon=True).start()
+
+
+def endpoint(url):
+    """
+    Name of a Doctolib endpoint, without ids.
+    """
+    path = urlsplit(url).path.strip('/')
+    return path.split('/')[0] or '/'
+
+
+class MetricsAdapter(BaseAdapter):
+    def __init__(self, adapter, metrics):
+        super().__init__()
+        self.adapter = adapter
+        self.metrics = metrics
+
+    def send(self, request, **kwargs):
+        center = getattr(self.metrics.context, 'center', None) or ''
+        name = endpoint(request.url)
+        started = time.monotonic()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except Exception:
+            self.metrics.inc('requests_total', endpoint=name, center=center, status='error')
+            raise
+        finally:
+            self.metrics.observe('request_seconds', time.monotonic() - started, endpoint=name)
+
+        self.metrics.inc('requests_total', endpoint=name, center=center, status=str(response.status_code))
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+METRICS = Metrics()
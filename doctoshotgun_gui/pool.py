@@ -0,0 +1,165 @@
+"""
+Shared connections and conditional requests.
+
+Every copy of the browser used by a search sends its requests through the
+same keep-alive connection pool, sized to the concurrency of the search,
+instead of opening its own connections. Responses of endpoints which
+barely change (center profiles and booking pages, the patient list) are
+kept, and requested again with If-None-Match/If-Modified-Since: Doctolib
+then answers 304 without a body, and the kept response is returned.
+
+Counters are collected in :data:`metrics.METRICS`: connections opened and
+requests sent through the pool, and conditional requests answered from
+the cache or not.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from doctoshotgun_gui.metrics import METRICS
+
+
+class ConnectionPool:
+    # Paths of the responses kept for conditional requests.
+    CACHED = (r'/booking/[^/]+\.json$', r'/account/master_patients\.json$')
+    MAX_ENTRIES = 256
+
+    def __init__(self, size, cache=True, metrics=None):
+        """
+        :param size: connections kept open to each host
+        :param cache: make conditional requests for :attr:`CACHED` paths
+        """
+        self.size = size
+        self.cache = cache
+        self.metrics = metrics or METRICS
+        self.lock = threading.Lock()
+        # URL -> kept response
+        self.entries = OrderedDict()
+        # (browser class, prefix) -> shared adapter
+        self.adapters = {}
+        # Connections of each shared adapter already counted.
+        self.counted = {}
+        self.cached_paths = [re.compile(path) for path in self.CACHED]
+
+    def install(self, browser):
+        """
+        Replace the transport adapters of this browser with the shared
+        ones. Must be installed before any other wrapping adapter, and
+        before the browser opens connections: the first browser of a class
+        lends its own adapters, with their connections, and the adapters of
+        the next ones are dropped.
+        """
+        adapters = browser.session.adapters
+        with self.lock:
+            for prefix, adapter in adapters.items():
+                if isinstance(adapter, PooledAdapter) or not hasattr(adapter, 'poolmanager'):
+                    continue
+
+                key = (type(browser), prefix)
+                if key not in self.adapters:
+                    # Same TLS settings as the session's own adapter. Its
+                    # pools are looked up by their size too, so they are
+                    # only resized when none is open yet, to keep open
+                    # connections.
+                    if not len(adapter.poolmanager.pools):
+                        adapter.poolmanager.connection_pool_kw['maxsize'] = self.size
+                    self.adapters[key] = PooledAdapter(adapter, self)
+                adapters[prefix] = self.adapters[key]
+
+    def is_cached(self, request):
+        return self.cache and request.method == 'GET' and \
+               any(path.search(request.path_url.split('?')[0]) for path in self.cached_paths)
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url, response):
+        headers = CaseInsensitiveDict(response.headers)
+        # Cookies are only set by the response carrying them.
+        headers.pop('Set-Cookie', None)
+        with self.lock:
+            self.entries[url] = (response.status_code, response.reason, headers, response.content,
+                                 response.encoding)
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def count_connections(self, adapter):
+        """
+        Count connections opened by this adapter since the last call.
+        """
+        pools = adapter.poolmanager.pools
+        total = sum(pool.num_connections for pool in map(pools.get, pools.keys()) if pool is not None)
+        with self.lock:
+            opened = total - self.counted.get(id(adapter), 0)
+            self.counted[id(adapter)] = total
+        self.metrics.inc('pool_requests_total')
+        if opened > 0:
+            self.metrics.inc('pool_connections_opened_total', opened)
+
+
+class PooledAdapter(BaseAdapter):
+    """
+    Shared by every browser of the same class.
+    """
+
+    def __init__(self, adapter, pool):
+        super().__init__()
+        self.adapter = adapter
+        self.pool = pool
+
+    def send(self, request, **kwargs):
+        entry = None
+        if self.pool.is_cached(request) and not kwargs.get('stream'):
+            entry = self.pool.get(request.url)
+            if entry is not None:
+                headers = entry[2]
+                if 'ETag' in headers:
+                    request.headers['If-None-Match'] = headers['ETag']
+                if 'Last-Modified' in headers:
+                    request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        response = self.adapter.send(request, **kwargs)
+        self.pool.count_connections(self.adapter)
+
+        if entry is not None and response.status_code == 304:
+            # Empty, read to give the connection back to the pool.
+            response.content
+            self.pool.metrics.inc('http_cache_total', result='hit')
+            return self.build_cached(request, response, entry)
+
+        if self.pool.is_cached(request) and not kwargs.get('stream'):
+            self.pool.metrics.inc('http_cache_total', result='miss')
+            if response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+                self.pool.put(request.url, response)
+        return response
+
+    def build_cached(self, request, not_modified, entry):
+        status, reason, headers, content, encoding = entry
+        response = Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = content
+        response._content_consumed = True
+        response.encoding = encoding
+        response.url = request.url
+        response.request = request
+        response.elapsed = not_modified.elapsed
+        # Cookies are read from the raw response, the one of the 304.
+        response.raw = not_modified.raw
+        response.connection = self
+        self.pool.metrics.inc('http_cache_bytes_saved_total', len(content))
+        return response
+
+    def close(self):
+        # Other browsers still use the connections.
+        pass
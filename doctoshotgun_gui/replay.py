@@ -0,0 +1,222 @@
+"""
+Record and replay Doctolib.
+
+:class:`Recorder` saves the HTTP exchanges of the browsers in a cassette
+(one JSON line per response). :class:`StandIn` serves a cassette from a
+local HTTP server, with configurable latency, errors and slot appearance,
+and :meth:`StandIn.install` points browsers to it.
+
+Request bodies, cookies and response headers other than the content type
+are never recorded, so cassettes don't contain credentials.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+from requests.adapters import BaseAdapter
+
+
+def relative_url(url):
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+class WrappingAdapter(BaseAdapter):
+    def __init__(self, adapter):
+        super().__init__()
+        self.adapter = adapter
+
+    def send(self, request, **kwargs):
+        return self.adapter.send(request, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+    @classmethod
+    def install(cls, browser, *args):
+        adapters = browser.session.adapters
+        for prefix, adapter in adapters.items():
+            adapters[prefix] = cls(adapter, *args)
+
+
+class RecordingAdapter(WrappingAdapter):
+    def __init__(self, adapter, recorder):
+        super().__init__(adapter)
+        self.recorder = recorder
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+        self.recorder.record(request, response)
+        return response
+
+
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def install(self, browser):
+        RecordingAdapter.install(browser, self)
+
+    def record(self, request, response):
+        exchange = {'method': request.method,
+                    'url': relative_url(request.url),
+                    'status': response.status_code,
+                    'content_type': response.headers.get('Content-Type', ''),
+                    'body': response.text,
+                   }
+        with self.lock:
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(exchange) + '\n')
+
+
+def load_cassette(path):
+    exchanges = {}
+    with open(path) as fp:
+        for line in fp:
+            exchange = json.loads(line)
+            parts = urlsplit(exchange['url'])
+            exchange['query'] = set(parse_qsl(parts.query))
+            exchanges.setdefault((exchange['method'], parts.path), []).append(exchange)
+    return exchanges
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, don't wait for the ACK of
+    # the headers.
+    disable_nagle_algorithm = True
+
+    def do(self):
+        server = self.server.standin
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+
+        status, content_type, body = server.respond(self.command, self.path)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandIn:
+    """
+    Local replay of a cassette.
+
+    :param latency: seconds added to every response
+    :param jitter: random extra latency, up to this many seconds
+    :param error_rate: part of the requests answered by a 503
+    :param slot_after: seconds after :meth:`start` before availabilities
+                       show their recorded slots, None to show them at once
+    """
+
+    def __init__(self, cassette, latency=0, jitter=0, error_rate=0, slot_after=None):
+        self.exchanges = load_cassette(cassette)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.slot_after = slot_after
+
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.started = None
+        self.server = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.started = time.monotonic()
+        threading.Thread(target=self.server.serve_forever, name='doctoshotgun-standin', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def install(self, browser):
+        RedirectAdapter.install(browser, self.url)
+
+    def find_exchange(self, method, url):
+        parts = urlsplit(url)
+        candidates = self.exchanges.get((method, parts.path))
+        if not candidates:
+            return None
+
+        # Dates and ids in query strings change between runs, take the
+        # recorded request sharing most parameters.
+        query = set(parse_qsl(parts.query))
+        return max(candidates, key=lambda exchange: len(query & exchange['query']))
+
+    def respond(self, method, url):
+        with self.lock:
+            self.requests += 1
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return 503, 'text/html', 'Service Unavailable'
+
+        exchange = self.find_exchange(method, url)
+        if exchange is None:
+            return 404, 'text/html', 'Not recorded'
+
+        body = exchange['body']
+        if self.slot_after is not None and time.monotonic() - self.started < self.slot_after \
+           and 'json' in exchange['content_type']:
+            body = self.hide_slots(body)
+        return exchange['status'], exchange['content_type'], body
+
+    @staticmethod
+    def hide_slots(body):
+        doc = json.loads(body)
+        if not isinstance(doc, dict) or 'availabilities' not in doc:
+            return body
+
+        for availability in doc['availabilities']:
+            availability['slots'] = []
+        doc['total'] = 0
+        doc.pop('next_slot', None)
+        return json.dumps(doc)
+
+
+class RedirectAdapter(WrappingAdapter):
+    """
+    Sends requests to the stand-in, but keeps the original URL on
+    responses so the browser still recognizes its pages.
+    """
+
+    def __init__(self, adapter, base_url):
+        super().__init__(adapter)
+        self.base_url = base_url
+
+    def send(self, request, **kwargs):
+        url = request.url
+        request.url = self.base_url + relative_url(url)
+        try:
+            response = self.adapter.send(request, **kwargs)
+        finally:
+            request.url = url
+        response.url = url
+        return response
@@ -0,0 +1,193 @@
+"""
+Request budget for Doctolib.
+
+Requests are paced by a token bucket per host. When Doctolib throttles or
+blocks us, the rate is halved and requests are held back for an
+exponentially growing, jittered delay; once responses are clean again the
+rate slowly goes back up.
+"""
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from requests.adapters import BaseAdapter
+from requests.exceptions import RequestException
+
+from woob.browser.exceptions import HTTPError
+from woob.exceptions import ScrapingBlocked
+from doctoshotgun.exceptions import WaitingInQueue
+
+
+def is_throttling(exception):
+    """
+    Whether this exception means Doctolib wants us to slow down.
+    """
+    if isinstance(exception, (ScrapingBlocked, WaitingInQueue)):
+        return True
+    if isinstance(exception, HTTPError):
+        return exception.response.status_code in Scheduler.THROTTLE_STATUSES
+    return False
+
+
+class Cancelled(RequestException):
+    """
+    Raised instead of sending a request held back when the search is
+    cancelled.
+    """
+
+
+class HostBudget:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.failures = 0
+        self.clean = 0
+
+    def reserve(self, now):
+        """
+        Take a token if one is available.
+
+        :returns: how long to wait before trying again, 0 if the token has
+                  been taken
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Scheduler:
+    """
+    Shared by every browser of a search, so the budget is global to the
+    account and not per connection.
+    """
+
+    RATE = 2.0          # requests per second at start
+    MIN_RATE = 0.1
+    MAX_RATE = 5.0
+    BURST = 4
+
+    BACKOFF = 2         # seconds, doubled at each consecutive throttling
+    MAX_BACKOFF = 600
+    RECOVERY = 20       # clean responses in a row before speeding up
+    SPEEDUP = 1.25
+
+    THROTTLE_STATUSES = (403, 429, 503)
+
+    def __init__(self, rate=None):
+        if rate is not None:
+            self.RATE = rate
+
+        self.lock = threading.Lock()
+        self.hosts = {}
+        # Set to stop holding requests back, e.g. when the search is
+        # cancelled.
+        self.cancelled = threading.Event()
+
+    def get_budget(self, host):
+        try:
+            return self.hosts[host]
+        except KeyError:
+            budget = self.hosts[host] = HostBudget(self.RATE, self.BURST)
+            return budget
+
+    def wait(self, host):
+        """
+        Block until a request to this host is allowed.
+
+        :returns: False if the wait has been interrupted by :attr:`cancelled`
+        """
+        while True:
+            with self.lock:
+                delay = self.get_budget(host).reserve(time.monotonic())
+            if delay <= 0:
+                return True
+            if self.cancelled.wait(delay):
+                return False
+
+    def success(self, host):
+        with self.lock:
+            budget = self.get_budget(host)
+            budget.failures = 0
+            budget.clean += 1
+            if budget.clean >= self.RECOVERY:
+                budget.clean = 0
+                budget.rate = min(self.MAX_RATE, budget.rate * self.SPEEDUP)
+
+    def throttled(self, host, retry_after=None):
+        """
+        Slow down requests to this host. Requests sent before the backoff
+        and throttled during it count as one throttling with the first.
+
+        :returns: the delay before the next request is allowed, in seconds
+        """
+        with self.lock:
+            budget = self.get_budget(host)
+            now = time.monotonic()
+            if now < budget.blocked_until:
+                if retry_after:
+                    budget.blocked_until = max(budget.blocked_until, now + retry_after)
+                return budget.blocked_until - now
+
+            budget.failures += 1
+            budget.clean = 0
+            budget.tokens = 0
+            budget.rate = max(self.MIN_RATE, budget.rate / 2)
+
+            backoff = min(self.MAX_BACKOFF, self.BACKOFF * 2 ** (budget.failures - 1))
+            backoff *= random.uniform(0.5, 1)
+            if retry_after:
+                backoff = max(backoff, retry_after)
+
+            budget.blocked_until = now + backoff
+            return backoff
+
+    def get_rate(self, host):
+        with self.lock:
+            return self.get_budget(host).rate
+
+    def install(self, browser):
+        """
+        Route every request of this browser through the scheduler.
+        """
+        adapters = browser.session.adapters
+        for prefix, adapter in adapters.items():
+            if not isinstance(adapter, ScheduledAdapter):
+                adapters[prefix] = ScheduledAdapter(adapter, self)
+
+
+class ScheduledAdapter(BaseAdapter):
+    """
+    Wraps the session's own transport adapter, so TLS settings of the
+    cloudscraper session are kept.
+    """
+
+    def __init__(self, adapter, scheduler):
+        super().__init__()
+        self.adapter = adapter
+        self.scheduler = scheduler
+
+    def send(self, request, **kwargs):
+        host = urlparse(request.url).netloc
+        if not self.scheduler.wait(host):
+            raise Cancelled('Search cancelled', request=request)
+
+        response = self.adapter.send(request, **kwargs)
+        if response.status_code in Scheduler.THROTTLE_STATUSES:
+            retry_after = response.headers.get('Retry-After', '')
+            self.scheduler.throttled(host, int(retry_after) if retry_after.isdigit() else None)
+        elif response.status_code < 400:
+            self.scheduler.success(host)
+        return response
+
+    def close(self):
+        self.adapter.close()
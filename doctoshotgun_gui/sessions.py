@@ -0,0 +1,94 @@
+"""
+Doctolib sessions of every account.
+
+Sessions are kept in memory, keyed by Doctolib site and login, so several
+accounts don't overwrite each other's session. Changes are written to disk
+from a background thread, at most every :attr:`SessionStore.DELAY`
+seconds, with an atomic rename.
+"""
+import json
+import threading
+
+from doctoshotgun_gui.files import read_json, write_atomic
+from doctoshotgun_gui.metrics import METRICS
+
+
+class SessionStore:
+    FILENAME = 'sessions.json'
+    DELAY = 2
+
+    def __init__(self, path=None, legacy_path=None):
+        """
+        :param path: file where sessions persist, None to keep them in memory
+        :param legacy_path: state.json of previous versions, holding one
+                            session, used for accounts without one
+        """
+        self.path = path
+        self.legacy_path = legacy_path
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.sessions = None
+        self.legacy = None
+        self.timer = None
+
+    @staticmethod
+    def key(browser):
+        return '%s|%s' % (browser.BASEURL, browser.username.lower())
+
+    def ensure_loaded(self):
+        if self.sessions is None:
+            with METRICS.time('load_state'):
+                self.sessions = read_json(self.path)
+                self.legacy = read_json(self.legacy_path)
+
+    def load(self, browser):
+        """
+        :returns: the saved state of this browser's account
+        """
+        with self.lock:
+            self.ensure_loaded()
+            state = self.sessions.get(self.key(browser))
+            if state is None:
+                state, self.legacy = self.legacy, {}
+            return state
+
+    def restore(self, browser):
+        browser.load_state(self.load(browser))
+
+    def save(self, browser):
+        """
+        Save the state of this browser's account, soon.
+        """
+        self.put(self.key(browser), browser.dump_state())
+
+    def put(self, key, state):
+        """
+        Save the state of the account with this :meth:`key`, soon.
+        """
+        with self.lock:
+            self.ensure_loaded()
+            self.sessions[key] = state
+            if self.timer is None and self.path is not None:
+                self.timer = threading.Timer(self.DELAY, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.timer = None
+            if self.sessions is None or self.path is None:
+                return
+            data = json.dumps(self.sessions)
+
+        with self.write_lock:
+            write_atomic(self.path, data)
+
+    def close(self):
+        """
+        Write pending changes now.
+        """
+        with self.lock:
+            timer = self.timer
+        if timer is not None:
+            timer.cancel()
+            self.flush()
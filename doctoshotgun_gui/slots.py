@@ -0,0 +1,98 @@
+"""
+Index of the slots already seen.
+
+Each appointment found is recorded by center, practice, vaccine and slot
+dates, with what became of it. Probes skip the ones the user turned down or
+which couldn't be booked, so the search doesn't stop again on them.
+
+Slots past their last date are dropped, and the index keeps at most
+:attr:`SlotIndex.MAX_ENTRIES` of them.
+"""
+import json
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from doctoshotgun_gui.files import read_json, write_atomic
+
+Slot = namedtuple('Slot', 'state last')
+
+
+class SlotIndex:
+    FILENAME = 'slots.json'
+
+    SEEN = 'seen'
+    REJECTED = 'rejected'
+    FAILED = 'failed'
+
+    # States of the slots skipped by probes.
+    SKIPPED = (REJECTED, FAILED)
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self, path=None):
+        """
+        :param path: file where the index persists, None to keep it in
+                     memory
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # key -> Slot
+        self.slots = self.load()
+
+    @staticmethod
+    def key(center, appointment):
+        return '|'.join([center['url'], appointment.address, appointment.vaccine] +
+                        [slot.isoformat() for slot in appointment.slots])
+
+    def load(self):
+        slots = read_json(self.path)
+        return self.pruned({key: Slot(*value) for key, value in slots.items()})
+
+    def pruned(self, slots):
+        # Past slots will not be found again.
+        now = datetime.now().isoformat()
+        slots = {key: slot for key, slot in slots.items() if slot.last >= now}
+        # The oldest entries first.
+        for key in list(slots)[:max(0, len(slots) - self.MAX_ENTRIES)]:
+            del slots[key]
+        return slots
+
+    def prune(self):
+        with self.lock:
+            count = len(self.slots)
+            self.slots = self.pruned(self.slots)
+            changed = len(self.slots) != count
+        if changed:
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            data = json.dumps(self.slots)
+
+        write_atomic(self.path, data)
+
+    def get(self, center, appointment):
+        """
+        :returns: the state of this appointment, None if it has never been
+                  seen
+        """
+        slot = self.slots.get(self.key(center, appointment))
+        return slot.state if slot else None
+
+    def is_skipped(self, center, appointment):
+        return self.get(center, appointment) in self.SKIPPED
+
+    def mark(self, center, appointment, state):
+        last = max(slot.isoformat() for slot in appointment.slots)
+        key = self.key(center, appointment)
+        with self.lock:
+            # Moved to the end, as the newest entry.
+            self.slots.pop(key, None)
+            self.slots[key] = Slot(state, last)
+            if len(self.slots) > self.MAX_ENTRIES:
+                self.slots = self.pruned(self.slots)
+        self.save()
@@ -0,0 +1,126 @@
+"""
+Memory soak test.
+
+Runs the search engine in long-run mode against a local replay of a
+cassette recorded with the headless mode's "record" option, with slots
+hidden so that the search never ends, for many sweeps::
+
+    python -m doctoshotgun_gui.soak cassette.jsonl --sweeps 20000 --max-growth 5
+
+Memory allocated since the end of the first --warmup sweeps is traced
+with tracemalloc. A JSON report is printed, and the test exits with an
+error when the memory still allocated at the end grew by more than
+--max-growth MB, showing the lines which allocated most of it.
+"""
+import argparse
+import gc
+import json
+import queue
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from doctoshotgun_gui.cache import CenterCache
+from doctoshotgun_gui.cli import COUNTRIES, MOTIVES
+from doctoshotgun_gui.engine import Search, SearchEngine, FoundEvent, ErrorEvent, StoppedEvent, SweepEvent
+from doctoshotgun_gui.replay import StandIn
+from doctoshotgun_gui.scheduler import Scheduler
+
+
+def soak(args):
+    """
+    :returns: the report, and the tracemalloc statistics of the lines
+              which allocated most since the warmup
+    """
+    # Slots are hidden until the stand-in has run forever.
+    standin = StandIn(args.cassette, slot_after=float('inf')).start()
+    scheduler = Scheduler(args.rate)
+    # Not limited by the recovery of the rate.
+    scheduler.MAX_RATE = args.rate
+    engine = SearchEngine(concurrency=args.concurrency, scheduler=scheduler,
+                          cache=CenterCache(), transports=[standin], long_run=True)
+    # Sweeps as fast as the rate allows.
+    engine.min_sweep_seconds = 0
+    try:
+        klass, _ = COUNTRIES[args.country]
+        engine.docto = klass('soak', 'soak')
+        engine.docto.patient = engine.docto.get_patients()[0]
+
+        motives = [getattr(engine.docto, motive) for motive in MOTIVES]
+        search = Search(args.cities, motives, date.today(), date.today() + timedelta(days=args.days - 1))
+        events = queue.Queue()
+        sweeps = 0
+        baseline = None
+
+        started = time.monotonic()
+        engine.start(events.put, search)
+        while True:
+            event = events.get()
+            if isinstance(event, SweepEvent):
+                sweeps += 1
+                if sweeps == args.warmup:
+                    gc.collect()
+                    tracemalloc.start()
+                    baseline = tracemalloc.take_snapshot()
+                if sweeps == args.sweeps:
+                    engine.cancel()
+            elif isinstance(event, FoundEvent):
+                raise RuntimeError('A slot has been found, the cassette must not show any')
+            elif isinstance(event, ErrorEvent):
+                raise event.exception
+            elif isinstance(event, StoppedEvent):
+                break
+        elapsed = time.monotonic() - started
+
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().compare_to(baseline, 'lineno')[:args.top]
+        tracemalloc.stop()
+    finally:
+        engine.shutdown()
+        standin.stop()
+
+    report = {'sweeps': sweeps,
+              'sweeps_per_second': sweeps / elapsed,
+              'probes': search.probes,
+              'requests': standin.requests,
+              'growth': current,
+              'peak_growth': peak,
+              # Kilobytes on Linux.
+              'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+             }
+    return report, top
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that a long search runs in bounded memory')
+    parser.add_argument('cassette', help='exchanges recorded with the "record" option')
+    parser.add_argument('--country', default='France', choices=list(COUNTRIES))
+    parser.add_argument('--cities', nargs='+', default=['paris'])
+    parser.add_argument('--days', type=int, default=7, help='days of availabilities searched')
+    parser.add_argument('--concurrency', type=int, default=None)
+    parser.add_argument('--rate', type=float, default=1000, help='requests per second')
+    parser.add_argument('--sweeps', type=int, default=20000)
+    parser.add_argument('--warmup', type=int, default=100, help='sweeps before measuring memory')
+    parser.add_argument('--max-growth', type=float, default=5, help='maximum memory growth, in MB')
+    parser.add_argument('--top', type=int, default=10, help='number of allocating lines to show')
+    args = parser.parse_args()
+
+    if args.warmup >= args.sweeps:
+        parser.error('--warmup must be lower than --sweeps')
+
+    report, top = soak(args)
+    print(json.dumps(report, indent=2))
+
+    if report['growth'] > args.max_growth * 1024 * 1024:
+        print('Memory grew by %.1fMB:' % (report['growth'] / 1024 / 1024), file=sys.stderr)
+        for stat in top:
+            print('  %s' % stat, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
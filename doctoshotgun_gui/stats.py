@@ -0,0 +1,134 @@
+"""
+Statistics of centers, to probe the likely ones first and more often.
+
+For each center, probes and hits (probes which found slots) are counted by
+hour of the week, and the time slots stay available is measured. Centers
+which usually release slots around the current time are probed first, at
+every sweep; the others less often, but at least every
+:attr:`CenterStats.MAX_PERIOD` sweeps.
+"""
+import json
+import threading
+import time
+from datetime import datetime
+
+from doctoshotgun_gui.files import read_json, write_atomic
+
+HOURS = 7 * 24
+
+
+def hour_of_week(timestamp=None):
+    now = datetime.fromtimestamp(timestamp or time.time())
+    return now.weekday() * 24 + now.hour
+
+
+class CenterStats:
+    FILENAME = 'stats.json'
+    # Weight of the overall hit rate of a center in the rate of an hour.
+    PRIOR = 5
+    # Hours around the current one taken into account.
+    WINDOW = 1
+    MAX_PERIOD = 10
+
+    def __init__(self, path=None):
+        """
+        :param path: file where statistics persist, None to keep them in
+                     memory
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.centers = self.load()
+        # Probes owed to each center, see schedule().
+        self.credits = {}
+
+    def load(self):
+        return read_json(self.path)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self.lock:
+            data = json.dumps(self.centers)
+
+        write_atomic(self.path, data)
+
+    def record(self, url, hit, timestamp=None):
+        """
+        Count a probe of a center.
+
+        :param hit: whether the center had slots
+        """
+        timestamp = timestamp or time.time()
+        hour = hour_of_week(timestamp)
+        with self.lock:
+            stats = self.centers.get(url)
+            if stats is None:
+                stats = self.centers[url] = {'probes': [0] * HOURS, 'hits': [0] * HOURS,
+                                             'available_since': None, 'releases': 0, 'available': 0}
+            stats['probes'][hour] += 1
+            if hit:
+                stats['hits'][hour] += 1
+                if stats['available_since'] is None:
+                    stats['available_since'] = timestamp
+            elif stats['available_since'] is not None:
+                # The slots are gone.
+                stats['releases'] += 1
+                stats['available'] += timestamp - stats['available_since']
+                stats['available_since'] = None
+
+    def survival(self, url):
+        """
+        Mean time slots of a center stay available, in seconds, or None.
+        """
+        stats = self.centers.get(url)
+        if not stats or not stats['releases']:
+            return None
+        return stats['available'] / stats['releases']
+
+    def score(self, url, timestamp=None):
+        """
+        Estimated probability that a probe of the center finds slots now.
+        """
+        stats = self.centers.get(url)
+        if stats is None:
+            return None
+
+        # Laplace smoothing, so centers never seen with slots still get
+        # probed from time to time.
+        overall = (sum(stats['hits']) + 1) / (sum(stats['probes']) + 2)
+        hour = hour_of_week(timestamp)
+        hours = [(hour + delta) % HOURS for delta in range(-self.WINDOW, self.WINDOW + 1)]
+        hits = sum(stats['hits'][h] for h in hours)
+        probes = sum(stats['probes'][h] for h in hours)
+        return (hits + overall * self.PRIOR) / (probes + self.PRIOR)
+
+    def schedule(self, centers):
+        """
+        Centers to probe in this sweep, most likely first.
+
+        Each center gets credits in proportion to its score, the best one a
+        full probe per sweep, and is probed when it has a whole one. Centers
+        without statistics are probed at every sweep.
+        """
+        with self.lock:
+            scores = [(center, self.score(center['url'])) for center in centers]
+        known = [score for center, score in scores if score is not None]
+        best = max(known) if known else 1
+
+        selected = []
+        for center, score in scores:
+            if score is None:
+                selected.append((center, best))
+                continue
+
+            # Every center is probed by the first sweep.
+            credit = self.credits.get(center['url'], 1) + max(score / best, 1 / self.MAX_PERIOD)
+            if round(credit, 6) >= 1:
+                selected.append((center, score))
+                credit -= 1
+            self.credits[center['url']] = credit
+
+        # Stable, so centers equally likely keep their order.
+        selected.sort(key=lambda item: item[1], reverse=True)
+        return [center for center, score in selected]